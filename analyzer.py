@@ -0,0 +1,66 @@
+"""
+Text analysis shared by index.py and search.py, so documents and queries are processed the same way:
+alphanumeric word tokens, Porter stemmed through a bounded cache
+"""
+import json
+import nltk
+import profiling
+from cache import LRUCache
+
+# Uncomment this line if your nltk package does not contain 'punkt'
+# nltk.download('punkt')
+
+STEM_CACHE_SIZE = 200000  # number of distinct words whose stem is kept
+STEM_CACHE_SUFFIX = '.stems'  # the stem cache is persisted next to the dictionary file with this suffix
+
+# alphanumeric words that word_tokenize still splits (its MacIntyre contractions)
+SPLIT_ALNUM_WORDS = {'cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna'}
+
+stemmer = nltk.stem.PorterStemmer()
+stem_cache = LRUCache(STEM_CACHE_SIZE)
+
+
+def tokenize(text):
+    """
+    Returns the alphanumeric tokens of text, the same as [w for w in word_tokenize(text) if w.isalnum()]
+
+    word_tokenize only splits inside a whitespace separated word around punctuation (and on a few
+    contractions), so text made only of plain alphanumeric words, as most queries are, is split on
+    whitespace directly. Anything else goes through word_tokenize, whose sentence splitting decides
+    whether e.g. a trailing period stays attached to a word.
+    """
+    words = text.split()
+    for word in words:
+        if not word.isalnum() or word.lower() in SPLIT_ALNUM_WORDS:
+            return [w for w in nltk.tokenize.word_tokenize(text) if w.isalnum()]
+    return words
+
+
+def stem(word):
+    stemmed = stem_cache.get(word)
+    if stemmed is None:
+        stemmed = stemmer.stem(word)
+        stem_cache.put(word, stemmed)
+    return stemmed
+
+
+def analyze(text):
+    """
+    Returns the stemmed alphanumeric tokens of text
+    """
+    with profiling.timer('tokenize'):
+        words = tokenize(text)
+    profiling.count('tokens', len(words))
+    with profiling.timer('stem'):
+        return [stem(word) for word in words]
+
+
+def save_stem_cache(path):
+    with open(path, 'w') as f:
+        json.dump(dict(stem_cache.items()), f)
+
+
+def load_stem_cache(path):
+    with open(path, 'r') as f:
+        for word, stemmed in json.load(f).items():
+            stem_cache.put(word, stemmed)
@@ -0,0 +1,9 @@
+"""
+Benchmarks of index.py and search.py
+
+    python3 -m bench.run -o bench.json
+
+generates a synthetic corpus (corpus.py), indexes it, runs a query workload on it and writes a JSON
+report of the time spent in each indexing phase and search stage, throughput, query latency
+percentiles and peak RSS. Run it from the root of the repository.
+"""
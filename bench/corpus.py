@@ -0,0 +1,92 @@
+"""
+Synthetic corpora and query workloads for the benchmarks
+
+Words are drawn from a generated vocabulary with Zipf distributed frequencies (the r-th most frequent
+word has a weight of 1 / r ** s), which gives the skew in posting list lengths of real text.
+Documents are written one per file named by doc_id, like reuters/training.
+"""
+import glob
+import itertools
+import os
+import random
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ne', 'ru', 'ta', 'vo', 'si', 'pe', 'da', 'gu', 'ri', 'zo', 'ba', 'fe', 'hi',
+             'ju', 'ly', 'mo', 'nu', 'po', 'sa', 'te', 'wi', 'xe', 'yo', 'ce', 'di', 'go', 'la']
+SENTENCE_LENGTH = 12  # average number of words between periods
+
+
+def make_vocabulary(size, seed=0):
+    """
+    Returns size distinct alphabetic words of 2 to 4 syllables, in random order
+    """
+    rng = random.Random(seed)
+    words = set()
+    for length in itertools.count(2):
+        for syllables in itertools.product(SYLLABLES, repeat=length):
+            words.add(''.join(syllables))
+            if len(words) == size:
+                break
+        if len(words) == size:
+            break
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+def zipf_weights(size, s=1.0):
+    """
+    Cumulative weights of ranks 1..size under a Zipf distribution of exponent s, for random.choices
+    """
+    return list(itertools.accumulate(1 / r ** s for r in range(1, size + 1)))
+
+
+def generate_corpus(out_dir, num_docs, doc_length=150, vocab_size=20000, zipf_s=1.0, seed=0):
+    """
+    Write num_docs documents to out_dir as files 1..num_docs
+
+    Document lengths are drawn uniformly between half and one and a half times doc_length words,
+    split into sentences ending with a period.
+    Returns the vocabulary, most frequent word first
+    """
+    rng = random.Random(seed)
+    vocabulary = make_vocabulary(vocab_size, seed)
+    cum_weights = zipf_weights(vocab_size, zipf_s)
+    os.makedirs(out_dir, exist_ok=True)
+    for doc_id in range(1, num_docs + 1):
+        length = rng.randint(doc_length // 2, doc_length * 3 // 2)
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=length)
+        sentences = []
+        for i in range(0, length, SENTENCE_LENGTH):
+            sentence = ' '.join(words[i:i + SENTENCE_LENGTH])
+            sentences.append(sentence[0].upper() + sentence[1:] + '.')
+        with open(os.path.join(out_dir, str(doc_id)), 'w') as f:
+            f.write('\n'.join(sentences))
+    return vocabulary
+
+
+def generate_queries(out_file, num_queries, vocabulary, query_length=(1, 6), zipf_s=1.0, seed=0):
+    """
+    Write num_queries queries, one per line, of query_length[0] to query_length[1] words drawn from
+    vocabulary (most frequent word first) with the same Zipf distribution as the corpus
+    """
+    rng = random.Random(seed + 1)
+    cum_weights = zipf_weights(len(vocabulary), zipf_s)
+    with open(out_file, 'w') as f:
+        for _ in range(num_queries):
+            length = rng.randint(*query_length)
+            f.write(' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=length)) + '\n')
+
+
+def sample_queries(in_dir, out_file, num_queries, query_length=(1, 6), seed=0):
+    """
+    Write num_queries queries made of words taken from random documents of an existing corpus
+    such as reuters/training, so real collections can be benchmarked with matching queries
+    """
+    rng = random.Random(seed + 1)
+    files = sorted(glob.glob(in_dir + '/*'))
+    with open(out_file, 'w') as f:
+        for _ in range(num_queries):
+            with open(rng.choice(files), 'r') as doc:
+                words = [word for word in doc.read().split() if word.isalpha()]
+            length = rng.randint(*query_length)
+            f.write(' '.join(rng.sample(words, min(length, len(words)))) + '\n')
@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""
+Report of the index size and ranking quality of static pruning and the secondary tier
+
+    python3 -m bench.pruning --prune-weight 0.3 --tier-df 0.05 -o pruning.json
+
+builds the full index and the tiered one (index.py --prune-weight and --tier-df) of the same corpus,
+ranks the same queries on both and compares their sizes and top k: the share of the full top k that
+the primary tier alone returns, and that it returns when falling back to the secondary tier, which
+happens for the queries with fewer than k results in the primary tier.
+"""
+import contextlib
+import getopt
+import io
+import json
+import os
+import sys
+import time
+
+from bench import run
+
+INDEX_FILES = ('dictionary.txt', 'postings.txt')
+
+
+def usage():
+    print("usage: python3 -m bench.pruning [--prune-weight W] [--tier-df F] [-o report.json] [-w work-dir]"
+          " [--docs N] [--corpus directory-of-documents] [--queries N] [--query-file FILE]"
+          " [--scorer dict|numpy|maxscore] [-k depth] [-b] [--binary-dict] [--seed N]")
+
+
+@contextlib.contextmanager
+def working_dir(path):
+    """
+    Run the block in path, then return to the current directory
+    """
+    cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+
+
+def build(in_dir, index_dir, options, prune_weight=0.0, tier_df=0.0):
+    """
+    Build the index of in_dir in index_dir, returns the bytes of its files
+    """
+    import index
+    os.makedirs(index_dir, exist_ok=True)
+    # build_index writes its block files in the working directory
+    with working_dir(index_dir), contextlib.redirect_stdout(io.StringIO()):
+        index.build_index(in_dir, INDEX_FILES[0], INDEX_FILES[1], options['binary'], False, options['binary_dict'],
+                          prune_weight=prune_weight, tier_df=tier_df)
+    return {name: os.path.getsize(os.path.join(index_dir, name)) for name in os.listdir(index_dir)}
+
+
+def rank_all(index_dir, queries_file, options, use_tier=True):
+    """
+    Returns (the top k of every query of queries_file, seconds spent ranking them)
+    """
+    import search
+    scorer, k = options['scorer'], options['k']
+    global_dict, postings = search.load_index(*(os.path.join(index_dir, name) for name in INDEX_FILES))
+    if postings.tier and not use_tier:
+        postings.tier.close()
+        postings.tier = None
+    accumulator = search.new_accumulator(global_dict, postings) if scorer in search.ACCUMULATOR_SCORERS else None
+    results = []
+    start = time.perf_counter()
+    with open(queries_file, 'r') as queries_fd:
+        for query in search.read_queries(queries_fd):
+            tokenized_query = search.parse_query(query, global_dict)
+            results.append(search.rank_query(tokenized_query, global_dict, postings, scorer, 0, k, False,
+                                             accumulator))
+    seconds = time.perf_counter() - start
+    postings.close()
+    return results, seconds
+
+
+def overlap(results, full_results):
+    """
+    Mean share of the full top k found in results, over the queries with results on the full index
+    """
+    shares = [len(set(result) & set(full)) / len(full) for result, full in zip(results, full_results) if full]
+    return round(sum(shares) / max(1, len(shares)), 4)
+
+
+def run_report(work_dir, options, prune_weight, tier_df):
+    """
+    Returns the report comparing the full and tiered indexes of the workload of options
+    """
+    work_dir, in_dir, queries_file = run.prepare_workload(work_dir, options)
+    full_dir = os.path.join(work_dir, 'full')
+    tiered_dir = os.path.join(work_dir, 'tiered')
+    full_sizes = build(in_dir, full_dir, options)
+    tiered_sizes = build(in_dir, tiered_dir, options, prune_weight, tier_df)
+
+    full_results, full_seconds = rank_all(full_dir, queries_file, options)
+    primary_results, primary_seconds = rank_all(tiered_dir, queries_file, options, use_tier=False)
+    tiered_results, tiered_seconds = rank_all(tiered_dir, queries_file, options)
+    k = options['k']
+    fallbacks = sum(1 for result, full in zip(primary_results, full_results) if full and len(result) < k)
+
+    full_postings = full_sizes[INDEX_FILES[1]]
+    primary_postings = tiered_sizes[INDEX_FILES[1]]
+    return {'config': dict(options, prune_weight=prune_weight, tier_df=tier_df),
+            'size': {'full': full_sizes, 'tiered': tiered_sizes,
+                     'primary_postings_ratio': round(primary_postings / full_postings, 4)},
+            'quality': {'primary_overlap': overlap(primary_results, full_results),
+                        'tiered_overlap': overlap(tiered_results, full_results),
+                        'identical_top_k': round(sum(1 for a, b in zip(tiered_results, full_results) if a == b)
+                                                 / max(1, len(full_results)), 4),
+                        'fallback_queries': fallbacks},
+            'search_seconds': {'full': round(full_seconds, 6), 'primary': round(primary_seconds, 6),
+                               'tiered': round(tiered_seconds, 6)}}
+
+
+if __name__ == '__main__':
+    report_file = None
+    work_dir = 'bench-pruning'
+    options = dict(run.DEFAULT_OPTIONS)
+    prune_weight = 0.0
+    tier_df = 0.05
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:w:k:b', ['prune-weight=', 'tier-df=', 'docs=', 'corpus=',
+                                                             'queries=', 'query-file=', 'scorer=', 'binary-dict',
+                                                             'seed='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-o':  # report file, printed if not given
+            report_file = a
+        elif o == '-w':  # directory for the generated corpus and both indexes
+            work_dir = a
+        elif o == '-k':
+            options['k'] = int(a)
+        elif o == '-b':
+            options['binary'] = True
+        elif o == '--binary-dict':
+            options['binary_dict'] = True
+        elif o == '--prune-weight':  # see index.py
+            prune_weight = float(a)
+        elif o == '--tier-df':  # see index.py
+            tier_df = float(a)
+        elif o == '--docs':  # size of the synthetic corpus
+            options['docs'] = int(a)
+        elif o == '--corpus':  # an existing corpus such as reuters/training instead
+            options['corpus'] = a
+        elif o == '--queries':  # number of generated queries
+            options['queries'] = int(a)
+        elif o == '--query-file':  # use these queries instead of generated ones
+            options['query_file'] = a
+        elif o == '--scorer':
+            options['scorer'] = a
+        elif o == '--seed':
+            options['seed'] = int(a)
+        else:
+            assert False, "unhandled option"
+
+    report = json.dumps(run_report(work_dir, options, prune_weight, tier_df), indent=2)
+    if report_file:
+        with open(report_file, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,207 @@
+#!/usr/bin/python3
+"""
+Index and search a corpus and write a JSON report of where the time goes
+
+Indexing phases, search stages and their counters come from the instrumentation of index.py and
+search.py (profiling.py), enabled in the process doing the work. Indexing and searching each run in
+a fresh process, so their timings and peak RSS are measured separately.
+"""
+import contextlib
+import getopt
+import io
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import resource
+import sys
+import time
+
+import profiling
+from bench import corpus
+
+DEFAULT_OPTIONS = {'docs': 5000, 'doc_length': 150, 'vocab': 20000, 'zipf': 1.0, 'corpus': None, 'queries': 1000,
+                   'query_file': None, 'scorer': 'dict', 'k': 10, 'min_match': 0, 'binary': False,
+                   'binary_dict': False, 'seed': 0, 'batch': 0}
+
+
+def usage():
+    print("usage: python3 -m bench.run [-o report.json] [-w work-dir] [--docs N] [--doc-length WORDS]"
+          " [--vocab N] [--zipf S] [--corpus directory-of-documents] [--queries N] [--query-file FILE]"
+          " [--scorer dict|numpy|maxscore|impact] [-k depth] [--conjunctive] [--batch N] [-b] [--binary-dict]"
+          " [--seed N]")
+
+
+def peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(sorted_values, q):
+    """
+    Nearest rank percentile of a sorted list, q in [0, 1]
+    """
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(q * len(sorted_values)) - 1))]
+
+
+def bench_index(in_dir, work_dir, options):
+    """
+    Build the index of in_dir in work_dir and return the indexing part of the report
+    Runs in its own process, see run_benchmark
+    """
+    import index
+    profiling.enable()
+    os.chdir(work_dir)   # build_index writes its block files in the working directory
+    num_docs = len(os.listdir(in_dir))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        index.build_index(in_dir, 'dictionary.txt', 'postings.txt', options['binary'], False,
+                          options['binary_dict'], impact=options['scorer'] == 'impact')
+    seconds = time.perf_counter() - start
+    profile = profiling.summary()
+    return {'seconds': round(seconds, 6), 'docs': num_docs, 'docs_per_second': round(num_docs / seconds, 3),
+            'phases': profile['stages'], 'counters': profile['counters'],
+            'postings_bytes': os.path.getsize('postings.txt'), 'dictionary_bytes': os.path.getsize('dictionary.txt'),
+            'peak_rss_kb': peak_rss_kb()}
+
+
+def bench_search(queries_file, work_dir, options):
+    """
+    Rank every query of queries_file against the index in work_dir and return the search part of the report
+    Runs in its own process, see run_benchmark
+    With options['batch'], the queries are ranked that many at a time by search.rank_batch, and each
+    query of a batch gets the mean latency of the batch.
+    """
+    import search
+    profiling.enable()
+    os.chdir(work_dir)
+    scorer, min_match, k, batch = options['scorer'], options['min_match'], options['k'], options['batch']
+    start = time.perf_counter()
+    global_dict, postings = search.load_index('dictionary.txt', 'postings.txt')
+    accumulator = None
+    if scorer in search.ACCUMULATOR_SCORERS or batch:
+        accumulator = search.new_accumulator(global_dict, postings)
+    latencies = []
+    with open(queries_file, 'r') as queries_fd:
+        queries = search.read_queries(queries_fd)
+        while batch:
+            batch_start = time.perf_counter()
+            tokenized_queries = [search.parse_query(query, global_dict) for query in itertools.islice(queries, batch)]
+            if not tokenized_queries:
+                break
+            search.rank_batch(tokenized_queries, global_dict, postings, k, False, accumulator)
+            latencies.extend([(time.perf_counter() - batch_start) / len(tokenized_queries)] * len(tokenized_queries))
+        for query in queries:
+            query_start = time.perf_counter()
+            tokenized_query = search.parse_query(query, global_dict)
+            search.rank_query(tokenized_query, global_dict, postings, scorer, min_match, k, False, accumulator)
+            latencies.append(time.perf_counter() - query_start)
+    seconds = time.perf_counter() - start
+    postings.close()
+
+    latencies.sort()
+    profile = profiling.summary()
+    return {'seconds': round(seconds, 6), 'queries': len(latencies),
+            'queries_per_second': round(len(latencies) / seconds, 3),
+            'latency_ms': {'mean': round(1000 * sum(latencies) / max(1, len(latencies)), 4),
+                           'p50': round(1000 * percentile(latencies, 0.5), 4),
+                           'p99': round(1000 * percentile(latencies, 0.99), 4),
+                           'max': round(1000 * percentile(latencies, 1.0), 4)},
+            'stages': profile['stages'], 'counters': profile['counters'], 'peak_rss_kb': peak_rss_kb()}
+
+
+def run_in_process(function, *args):
+    with multiprocessing.Pool(1, maxtasksperchild=1) as pool:
+        return pool.apply(function, args)
+
+
+def prepare_workload(work_dir, options):
+    """
+    Generate (or take) the corpus and queries of options in work_dir
+    Returns the absolute paths (work_dir, corpus directory, queries file)
+    """
+    work_dir = os.path.abspath(work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+    queries_file = os.path.abspath(options['query_file'] or os.path.join(work_dir, 'queries.txt'))
+    if options['corpus']:
+        in_dir = os.path.abspath(options['corpus'])
+        if not options['query_file']:
+            corpus.sample_queries(in_dir, queries_file, options['queries'], seed=options['seed'])
+    else:
+        in_dir = os.path.join(work_dir, 'corpus')
+        vocabulary = corpus.generate_corpus(in_dir, options['docs'], options['doc_length'], options['vocab'],
+                                            options['zipf'], options['seed'])
+        if not options['query_file']:
+            corpus.generate_queries(queries_file, options['queries'], vocabulary, zipf_s=options['zipf'],
+                                    seed=options['seed'])
+    return work_dir, in_dir, queries_file
+
+
+def run_benchmark(work_dir, options):
+    """
+    Generate (or take) the corpus and queries, then benchmark indexing and searching
+    Returns the report
+    """
+    work_dir, in_dir, queries_file = prepare_workload(work_dir, options)
+    return {'config': options,
+            'index': run_in_process(bench_index, in_dir, work_dir, options),
+            'search': run_in_process(bench_search, queries_file, work_dir, options)}
+
+
+if __name__ == '__main__':
+    report_file = None
+    work_dir = 'bench-work'
+    options = dict(DEFAULT_OPTIONS)
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'o:w:k:b', ['docs=', 'doc-length=', 'vocab=', 'zipf=', 'corpus=',
+                                                             'queries=', 'query-file=', 'scorer=', 'conjunctive',
+                                                             'batch=', 'binary-dict', 'seed='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-o':  # report file, printed if not given
+            report_file = a
+        elif o == '-w':  # directory for the generated corpus and the index
+            work_dir = a
+        elif o == '-k':
+            options['k'] = int(a)
+        elif o == '-b':
+            options['binary'] = True
+        elif o == '--binary-dict':
+            options['binary_dict'] = True
+        elif o == '--docs':  # size of the synthetic corpus
+            options['docs'] = int(a)
+        elif o == '--doc-length':  # average words per synthetic document
+            options['doc_length'] = int(a)
+        elif o == '--vocab':  # distinct words of the synthetic corpus
+            options['vocab'] = int(a)
+        elif o == '--zipf':  # exponent of the word frequency distribution
+            options['zipf'] = float(a)
+        elif o == '--corpus':  # benchmark an existing corpus such as reuters/training instead
+            options['corpus'] = a
+        elif o == '--queries':  # number of generated queries
+            options['queries'] = int(a)
+        elif o == '--query-file':  # use these queries instead of generated ones
+            options['query_file'] = a
+        elif o == '--scorer':
+            options['scorer'] = a
+        elif o == '--conjunctive':
+            options['min_match'] = -1  # search.ALL_TERMS
+        elif o == '--batch':  # rank this many queries at a time with search.rank_batch
+            options['batch'] = int(a)
+        elif o == '--seed':
+            options['seed'] = int(a)
+        else:
+            assert False, "unhandled option"
+
+    report = json.dumps(run_benchmark(work_dir, options), indent=2)
+    if report_file:
+        with open(report_file, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
@@ -0,0 +1,81 @@
+"""
+Bounded least recently used cache with hit/miss counters
+"""
+import collections
+import itertools
+import threading
+
+
+class LRUCache:
+    """
+    Mapping that keeps at most max_entries items, and at most max_bytes bytes as measured by sizeof(value),
+    evicting the least recently used items first. A limit of None means no limit.
+    Safe to share between threads.
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = collections.OrderedDict()
+        self.sizes = {}  # bytes of each entry, only kept with max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = 0
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            if size > self.max_bytes:  # would evict everything else, never cached
+                return
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.sizes.pop(key, 0)
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if self.max_bytes is not None:
+                self.sizes[key] = size
+                self.bytes += size
+            while (self.max_entries is not None and len(self.entries) > self.max_entries) or \
+                    (self.max_bytes is not None and self.bytes > self.max_bytes):
+                old_key, _ = self.entries.popitem(last=False)
+                self.bytes -= self.sizes.pop(old_key, 0)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.sizes.clear()
+            self.bytes = 0
+
+    def items(self):
+        """
+        Items from the least to the most recently used
+        """
+        with self.lock:
+            return list(self.entries.items())
+
+    def recent(self, n):
+        """
+        The n most recently used items, the most recent first
+        """
+        with self.lock:
+            return list(itertools.islice(reversed(self.entries.items()), n))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
@@ -1,34 +1,79 @@
 #!/usr/bin/python3
 import re
-import nltk
 import sys
+import array
 import getopt
 import os, glob
+import shutil
+import tempfile
+import io
 import json
-import linecache
 import math
+import heapq
+import multiprocessing
+import subprocess
+import postings_format
+import lexicon
+import analyzer
+import segments
+import profiling
+import reorder
 
-# Uncomment this line if your nltk package does not contain 'punkt'
-# nltk.download('punkt') 
-
-stemmer = nltk.stem.PorterStemmer()
 universal_id_set = [] # list of all doc_id in the collection
 UNIVERSAL = '_universal' # string representing the dummy term that exists in all docs (doc_freq = N)
+MERGE_BUFFER_SIZE = 8 * 1024 * 1024 # bytes of read buffers shared by all blocks during the merge
+BLOCK_TERM_BYTES = 2 * sys.getsizeof(array.array('d')) + sys.getsizeof((0, 0)) + sys.getsizeof('') + 100 # per term
+BLOCK_POSTING_BYTES = 4 + 8 # uint32 doc_id and float64 tf in the arrays of a CompactBlock
+DOCUMENT_CHUNK = 16 # documents handed to a worker at a time when blocks are sized by memory
+SHARD_BY = ('range', 'hash')  # contiguous doc_id ranges, or doc_id modulo the number of shards
+MERGE_FAN_IN = 256  # most block files merged at once, more are first merged into runs (merge_runs)
+TIER_BLOCK = 'tier_block'  # postings moved to the secondary tier, in the block format, while writing postings.txt
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file")
+    print("usage: " + sys.argv[0] + " -i directory-of-documents -d dictionary-file -p postings-file"
+          " [-b] [--quantize] [--binary-dict] [--workers N] [--merge-buffer BYTES] [--memory-budget BYTES]"
+          " [--stem-cache] [--profile FILE] [[--reorder] [--impact] [--positions] [--prune-weight W] [--tier-df F]"
+          " | --add | --shards N [--shard-by range|hash]]")
+    print("       " + sys.argv[0] + " -d dictionary-file (--delete doc_id,doc_id,... | -p postings-file --compact)")
 
 
-def build_index(in_dir, out_dict, out_postings):
+def build_index(in_dir, out_dict, out_postings, binary=False, quantize=False, binary_dict=False, workers=1,
+                merge_buffer=MERGE_BUFFER_SIZE, persist_stems=False, stem_cache_file=None, files=None,
+                memory_budget=0, impact=False, prune_weight=0.0, tier_df=0.0, reorder_docs=False, positions=False):
     """
     build index from documents stored in the input directory,
     then output the dictionary file and postings file
+
+    binary: write the postings in the binary format of postings_format.py instead of text
+    quantize: store binary weights as 16 bit integers instead of float32
+    binary_dict: write the dictionary as the binary lexicon of lexicon.py instead of json
+    workers: number of processes used to tokenize and invert blocks
+    merge_buffer: total size in bytes of the read buffers used when merging the blocks
+    persist_stems: load and save the stem cache of analyzer.py next to the dictionary file,
+                   or in stem_cache_file if given
+    files: the document files to index, every file in in_dir by default
+    memory_budget: flush a block once its in-memory index reaches this many bytes instead of
+                   every 1000 documents (0)
+    impact: also write the impact ordered copy of the postings (postings_format.py) to
+            out_postings + postings_format.IMPACT_SUFFIX for search.py --scorer impact
+    prune_weight: move the postings weighing less than this fraction of the largest weight of their
+                  term to the secondary tier (see segments.TieredIndex)
+    tier_df: keep at most this fraction of the collection (at least one posting) in the posting list of
+             a term, the postings of lowest weight of longer lists are moved to the secondary tier
+    reorder_docs: renumber the documents so that similar ones get nearby doc_ids, see reorder_postings
+    positions: also write the positions of the terms in the docs to out_postings +
+               postings_format.POSITIONS_SUFFIX, for the phrase and proximity operators of search.py
     """
     print('indexing...')
 
+    stem_cache_file = stem_cache_file or out_dict + analyzer.STEM_CACHE_SUFFIX
+    if persist_stems and os.path.exists(stem_cache_file):
+        analyzer.load_stem_cache(stem_cache_file)   # before the workers are forked, so they start warm
+
     block_size = 1000  # Arbitrary. Can be higher if memory allows for it
-    files = glob.glob(in_dir + "/*")
+    if files is None:
+        files = glob.glob(in_dir + "/*")
     if len(files) == 0:
         print('Document files not found. Check directory argument -i')
         return
@@ -37,35 +82,298 @@ def build_index(in_dir, out_dict, out_postings):
     files.sort(key=lambda f: int(os.path.basename(f)))
     term_to_id = {}
     next_term_id = 0
-    universal_id_set.extend([int(os.path.basename(file)) for file in files])
+    universal_id_set[:] = [int(os.path.basename(file)) for file in files]
+
+    impact_file = out_postings + postings_format.IMPACT_SUFFIX
+    doc_map_file = out_postings + postings_format.DOC_MAP_SUFFIX
+    positions_file = out_postings + postings_format.POSITIONS_SUFFIX
+    tier_files = (out_dict + segments.TIER_SUFFIX, out_postings + segments.TIER_SUFFIX)
+    # Every file is written under a temporary name and moved into place once the index is complete,
+    # the dictionary last, so a search server reloading the index (search.py --serve) never maps a
+    # half written file
+    staged = []
+
+    def staging(path):
+        staged.append(path)
+        return path + postings_format.TMP_SUFFIX
+
+    # The blocks of this build go to a directory of their own, removed even when the build fails,
+    # so that no later build merges them
+    block_dir = tempfile.mkdtemp(prefix='blocks', dir='.')
+    try:
+        block_id = 0
+        block_files = []
+        block_total = math.ceil(len(files) / block_size)
+        pool = multiprocessing.Pool(workers) if workers > 1 else None
+        if memory_budget:
+            # Documents are still tokenized in parallel, but added to the block in order of doc_id
+            blocks = fill_blocks(files, memory_budget, pool, positions, persist_stems)
+        elif pool:
+            # Blocks are tokenized and inverted in parallel, but still written in order of block_id
+            # so term_ids are assigned exactly as in a serial run
+            # Workers send back their stems when the cache is persisted
+            blocks = pool.imap(build_block, [(files, i, block_size, persist_stems, positions)
+                                             for i in range(block_total)])
+        else:
+            blocks = (build_block((files, i, block_size, False, positions)) for i in range(block_total))
+        for block_index, stems in blocks:
+            print(f'processing block {block_id}')
+            block_files.append(os.path.join(block_dir, "block{:03d}".format(block_id)))
+            next_term_id = write_block_to_disk(block_index, term_to_id, next_term_id, block_files[-1])
+            block_id += 1
+            for word, stemmed in (stems or {}).items():
+                analyzer.stem_cache.put(word, stemmed)
+        if pool:
+            pool.close()
+            pool.join()
+        if persist_stems:
+            analyzer.save_stem_cache(stem_cache_file)
+
+        # Merge all blocks into one block (postings.txt), at most MERGE_FAN_IN of them at once
+        block_files = merge_runs(block_files, merge_buffer)
+        if reorder_docs:
+            merged_postings = reorder_postings(block_files, staging(doc_map_file), merge_buffer)
+        else:
+            merged_postings = merge_blocks(block_files, merge_buffer)
+
+        # Write postings.txt with skip pointers (text) or gap encoded varints with a skip table (binary)
+        # while merging, collecting the offsets and doc_freqs for the dictionary
+        weight_format = None
+        if binary:
+            weight_format = postings_format.WEIGHT_UINT16 if quantize else postings_format.WEIGHT_FLOAT32
+        tier = None
+        if prune_weight or tier_df:
+            tier = (prune_weight, max(1, math.floor(tier_df * len(universal_id_set))) if tier_df else 0)
+        tier_block_file = os.path.join(block_dir, TIER_BLOCK)
+        dictionary_entries = write_postings(merged_postings, staging(out_postings), weight_format, merge_buffer,
+                                            staging(impact_file) if impact else None, tier,
+                                            staging(positions_file) if positions else None, tier_block_file)
+
+        # Write the secondary tier, numbering its terms from 0 again
+        if tier and os.path.getsize(tier_block_file):
+            tier_ids = {}
+
+            def tier_postings():
+                for term_id, posting_list in merge_blocks([tier_block_file], merge_buffer):
+                    tier_ids[term_id] = len(tier_ids)
+                    yield tier_ids[term_id], posting_list
+
+            tier_entries = write_postings(tier_postings(), staging(tier_files[1]), weight_format, merge_buffer)
+            tier_term_to_id = {term: tier_ids[term_id] for term, term_id in term_to_id.items()
+                               if term_id in tier_ids}
+            write_dictionary(tier_term_to_id, staging(tier_files[0]), tier_entries, binary_dict)
+            print(f'moved the postings of {len(tier_ids)} terms to the secondary tier')
+
+        # Write dictionary (dictionary.txt)
+        write_dictionary(term_to_id, staging(out_dict), dictionary_entries, binary_dict)
+
+        for old_file in (impact_file, doc_map_file, positions_file) + tier_files:
+            # left by an earlier build, it would not match the new postings
+            if old_file not in staged and os.path.exists(old_file):
+                os.remove(old_file)
+        for path in staged:
+            os.replace(path + postings_format.TMP_SUFFIX, path)
+    finally:
+        shutil.rmtree(block_dir, ignore_errors=True)
+        for path in staged:
+            if os.path.exists(path + postings_format.TMP_SUFFIX):   # the build failed before moving it into place
+                os.remove(path + postings_format.TMP_SUFFIX)
+
+
+def build_shards(in_dir, manifest_file, out_postings, num_shards, shard_by='range', binary=False, quantize=False,
+                 binary_dict=False, workers=1, merge_buffer=MERGE_BUFFER_SIZE, persist_stems=False,
+                 memory_budget=0):
+    """
+    Partition the documents of in_dir into num_shards shards, by contiguous doc_id ranges or by doc_id
+    modulo num_shards, and build each one with build_index into manifest_file.i and out_postings.i
+
+    The shards are listed in a manifest written at manifest_file (see segments.py), marked as sharded so
+    search.py ranks every shard in its own process with the statistics of the whole collection.
+    """
+    files = glob.glob(in_dir + "/*")
+    files.sort(key=lambda f: int(os.path.basename(f)))
+    if shard_by == 'hash':
+        shards = [[f for f in files if int(os.path.basename(f)) % num_shards == i] for i in range(num_shards)]
+    else:
+        shard_size = math.ceil(len(files) / num_shards)
+        shards = [files[i * shard_size:(i + 1) * shard_size] for i in range(num_shards)]
+
+    manifest = {'_segments': [], '_next_segment': 0, '_shards': shard_by}
+    for i, shard_files in enumerate(shards):
+        if not shard_files:
+            continue
+        print(f'building shard {i}')
+        shard_dict = f'{manifest_file}.{i}'
+        shard_postings = f'{out_postings}.{i}'
+        build_index(in_dir, shard_dict, shard_postings, binary, quantize, binary_dict, workers, merge_buffer,
+                    persist_stems, manifest_file + analyzer.STEM_CACHE_SUFFIX, shard_files, memory_budget)
+        manifest['_segments'].append(new_segment(manifest_file, shard_dict, shard_postings))
+    manifest['_next_segment'] = num_shards
+    with segments.ManifestLock(manifest_file):
+        segments.write_manifest(manifest_file, manifest)
+
+
+def add_documents(in_dir, manifest_file, out_postings, binary=False, quantize=False, binary_dict=False, workers=1,
+                  merge_buffer=MERGE_BUFFER_SIZE, persist_stems=False, memory_budget=0):
+    """
+    Index the documents of in_dir into a new delta segment of the segmented index at manifest_file
+    (see segments.py), without touching the existing segments
+
+    A plain index already at manifest_file and out_postings becomes the first segment. Docs already
+    in the index are replaced: their older copies are tombstoned. Above segments.MAX_SEGMENTS
+    segments, a compaction is started in the background, except for a sharded index whose new
+    segment is searched as one more shard.
+    """
+    if os.path.exists(out_postings + postings_format.DOC_MAP_SUFFIX):
+        print('the documents of this index were reordered (--reorder), rebuild it instead')
+        return
+    if os.path.exists(out_postings + postings_format.IMPACT_SUFFIX):
+        print('this index has impact ordered postings (--impact), rebuild it instead')
+        return
+    if os.path.exists(out_postings + postings_format.POSITIONS_SUFFIX):
+        print('this index has the positions of its terms (--positions), rebuild it instead')
+        return
+    if os.path.exists(manifest_file + segments.TIER_SUFFIX):
+        print('this index has a secondary tier (--prune-weight, --tier-df), rebuild it instead')
+        return
+    with segments.ManifestLock(manifest_file):
+        manifest = open_manifest(manifest_file, out_postings)
+        segment_id = manifest['_next_segment']
+        manifest['_next_segment'] += 1
+        segments.write_manifest(manifest_file, manifest)
+
+    segment_dict = f'{manifest_file}.{segment_id}'
+    segment_postings = f'{out_postings}.{segment_id}'
+    build_index(in_dir, segment_dict, segment_postings, binary, quantize, binary_dict, workers, merge_buffer,
+                persist_stems, manifest_file + analyzer.STEM_CACHE_SUFFIX, memory_budget=memory_budget)
+    if not universal_id_set:
+        return
+
+    with segments.ManifestLock(manifest_file):
+        manifest = segments.read_manifest(manifest_file)
+        add_tombstones(manifest_file, manifest, universal_id_set)
+        manifest['_segments'].append(new_segment(manifest_file, segment_dict, segment_postings))
+        segments.write_manifest(manifest_file, manifest)
+    print(f'added {len(universal_id_set)} docs to segment {segment_id}')
+
+    if len(manifest['_segments']) > segments.MAX_SEGMENTS and '_shards' not in manifest:
+        print('starting a background compaction')
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), '-d', manifest_file, '-p', out_postings,
+                          '--compact'], stdout=subprocess.DEVNULL, start_new_session=True)
+
+
+def delete_documents(manifest_file, doc_ids):
+    """
+    Record tombstones for doc_ids in the segmented index at manifest_file
+    """
+    with segments.ManifestLock(manifest_file):
+        manifest = segments.read_manifest(manifest_file)
+        deleted = add_tombstones(manifest_file, manifest, doc_ids)
+        segments.write_manifest(manifest_file, manifest)
+    missing = set(doc_ids) - deleted
+    if missing:
+        print(f'docs not in the index: {sorted(missing)}')
+    print(f'deleted {len(deleted)} docs')
+
 
-    block_id = 0
-    block_total = math.ceil(len(files) / block_size)
-    while block_id < block_total:
-        print(f'processing block {block_id}')
-        block = parse_block(files, block_id, block_size)
-        block_index = bsbi_invert(block)
-        next_term_id = write_block_to_disk(block_index, term_to_id, next_term_id, block_id)
-        block_id += 1
+def compact_segments(manifest_file, out_postings, merge_buffer=MERGE_BUFFER_SIZE):
+    """
+    Fold every segment of the segmented index at manifest_file into one, dropping the deleted docs
+
+    The live postings of each term are merged from the segments and written with write_postings, in
+    the format of the first segment. Segments added meanwhile are kept, and docs deleted meanwhile
+    are tombstoned in the new segment, so --add and --delete can run during a compaction.
+    """
+    with segments.ManifestLock(manifest_file):
+        manifest = segments.read_manifest(manifest_file)
+        old_segments = manifest['_segments']
+        if '_shards' in manifest:
+            print('a sharded index is not compacted')
+            return
+        if len(old_segments) < 2 and not any(segment['deleted'] for segment in old_segments):
+            print('nothing to compact')
+            return
+        segment_id = manifest['_next_segment']
+        manifest['_next_segment'] += 1
+        segments.write_manifest(manifest_file, manifest)
+
+    print(f'compacting {len(old_segments)} segments')
+    index = segments.SegmentedIndex(manifest_file, old_segments)
+    global_dict, postings, _ = index.segments[0]
+    universal_id_set[:] = index.doc_ids
+    term_to_id = {}
 
-    # Merge all blocks into one block (postings.txt)
-    next_block_id = block_id
-    block_files = glob.glob("block*")
-    block_files.sort(key = lambda f : int(os.path.basename(f)[5:]))
-    while len(block_files) > 1:
-        next_block_id = merge_blocks(block_files, next_block_id)
-        block_files = glob.glob("block*")
-        block_files.sort(key = lambda f : int(os.path.basename(f)[5:]))
+    def merged_postings():
+        for term in index.terms():
+            posting_list = index.term_postings(term)
+            if posting_list:
+                term_to_id[term] = len(term_to_id)
+                yield term_to_id[term], [f'{doc_id},{weight}' for doc_id, weight in posting_list]
+
+    segment_dict = f'{manifest_file}.{segment_id}'
+    segment_postings = f'{out_postings}.{segment_id}'
+    entries = write_postings(merged_postings(), segment_postings, postings.weight_format, merge_buffer)
+    write_dictionary(term_to_id, segment_dict, entries, isinstance(global_dict, lexicon.Lexicon))
+    index.close()
+
+    with segments.ManifestLock(manifest_file):
+        manifest = segments.read_manifest(manifest_file)
+        names = [segment['dict'] for segment in manifest['_segments']]
+        if any(segment['dict'] not in names for segment in old_segments):  # compacted by someone else
+            os.remove(segment_dict)
+            os.remove(segment_postings)
+            return
+        segment = new_segment(manifest_file, segment_dict, segment_postings)
+        current = dict(zip(names, manifest['_segments']))
+        for old_segment in old_segments:
+            segment['deleted'].extend(set(current[old_segment['dict']]['deleted']) - set(old_segment['deleted']))
+        segment['deleted'].sort()
+        # the old segments are contiguous, segments added since the compaction started come after them
+        first = names.index(old_segments[0]['dict'])
+        manifest['_segments'][first:first + len(old_segments)] = [segment]
+        segments.write_manifest(manifest_file, manifest)
+
+    for old_segment in old_segments:
+        os.remove(segments.segment_path(manifest_file, old_segment['dict']))
+        os.remove(segments.segment_path(manifest_file, old_segment['postings']))
+    print(f'compacted into segment {segment_id}')
+
+
+def open_manifest(manifest_file, out_postings):
+    """
+    Returns the manifest at manifest_file, turning a plain index there into its first segment
+    """
+    if not os.path.exists(manifest_file):
+        return {'_segments': [], '_next_segment': 0}
+    if segments.is_manifest(manifest_file):
+        return segments.read_manifest(manifest_file)
+    os.replace(manifest_file, f'{manifest_file}.0')
+    os.replace(out_postings, f'{out_postings}.0')
+    segment = new_segment(manifest_file, f'{manifest_file}.0', f'{out_postings}.0')
+    return {'_segments': [segment], '_next_segment': 1}
 
-    if os.path.exists(out_postings):
-        os.remove(out_postings)
-    os.rename(block_files[0], out_postings)
 
-    # read in postings.txt and insert skip pointers
-    add_skip_pointers(out_postings)
+def new_segment(manifest_file, segment_dict, segment_postings):
+    manifest_dir = os.path.dirname(manifest_file) or '.'
+    return {'dict': os.path.relpath(segment_dict, manifest_dir),
+            'postings': os.path.relpath(segment_postings, manifest_dir), 'deleted': []}
 
-    # Write dictionary (dictionary.txt)
-    write_dictionary(term_to_id, out_dict, out_postings)
+
+def add_tombstones(manifest_file, manifest, doc_ids):
+    """
+    Add the live doc_ids found in the segments of manifest to their deleted list
+    Returns the set of doc_ids deleted
+    """
+    doc_ids = set(doc_ids)
+    deleted = set()
+    for segment in manifest['_segments']:
+        global_dict, postings = segments.open_segment(manifest_file, segment)
+        found = doc_ids.intersection(segments.universal_doc_ids(global_dict, postings))
+        postings.close()
+        found -= set(segment['deleted'])
+        segment['deleted'].extend(sorted(found))
+        deleted |= found
+    return deleted
 
 
 def read_file(filename):
@@ -78,30 +386,28 @@ def read_file(filename):
     return contents
 
 
-def gen_tuples(contents, doc_id):
+def gen_tuples(contents, doc_id, positions=False):
     """
     tokenize the entire file's content into a list of [(term, doc_id), (term, doc_id), ...]
 
     Apply pre-processing steps such as removal of punctuation, stemming
+    positions: see get_doc_vector
     """
 
-    words = nltk.tokenize.word_tokenize(contents)
-
-    # Removed punctuations
-    words = [word for word in words if word.isalnum()]
-
-    # Apply Porter Stemming (seems to have applied lowercase as well)
-    words = [stemmer.stem(word) for word in words]
+    # Tokenize, remove punctuations and apply Porter Stemming (seems to have applied lowercase as well),
+    # with the stems cached by the analyzer shared with search.py
+    words = analyzer.analyze(contents)
 
     # # remove duplicates
     # words = list(dict.fromkeys(words))
-    tuples = get_doc_vector(words, doc_id)
+    tuples = get_doc_vector(words, doc_id, positions)
 
     return tuples
 
-def get_doc_vector(terms, doc_id):
+def get_doc_vector(terms, doc_id, positions=False):
     """
     Returns a list of tuples (term, doc_id, tf) for a given doc
+    With positions, the tuples are (term, doc_id, tf, 'p1:p2:...'), the positions of the term in terms
     """
     # Get the term frequency for each term in the doc
     term_freq = {}
@@ -131,59 +437,133 @@ def get_doc_vector(terms, doc_id):
     #     sum_of_squares += term_freq[term]**2
     # print(sum_of_squares)
     
+    if positions:
+        term_positions = {}
+        for position, term in enumerate(terms):
+            term_positions.setdefault(term, []).append(str(position))
+        return [(term, doc_id, term_freq[term], ':'.join(term_positions[term])) for term in term_freq]
+
     return [(term, doc_id, term_freq[term]) for term in term_freq]
 
-def parse_block(files, block_id, block_size):
+@profiling.timed('parse')
+def parse_document(filename, positions=False):
     """
-    Reads a block of files and generate a list of (term, doc_id) tuples
+    Reads a document and returns its list of (term, doc_id, tf) tuples, or (term, doc_id, tf, positions)
     """
-    block_of_tuples = []
-    file_idx = block_id * block_size
-    for i in range(file_idx, min(file_idx + block_size, len(files))):
-        filename = files[i]
+    with profiling.timer('read'):
         contents = read_file(filename)
-        doc_id = int(os.path.basename(filename))
-        tuples = gen_tuples(contents, doc_id)
-        block_of_tuples.extend(tuples)
-    return block_of_tuples
+    profiling.count('docs')
+    doc_id = int(os.path.basename(filename))
+    return gen_tuples(contents, doc_id, positions)
 
 
-def bsbi_invert(block):
+class CompactBlock:
     """
-    Converts the list of (term, doc_id) tuples into an inverted index of the form
+    In-memory inverted index of a block, of the form
     {
-        'term1' : [(1, tf), (5, tf), (9, tf), (20,tf), ...],
-        'term2' : [(3, td), (9, tf), (30, tf)]
+        'term1' : (array of doc_ids [1, 5, 9, 20, ...], array of tfs),
+        'term2' : (array of doc_ids [3, 9, 30], array of tfs)
     }
+    Documents are added in increasing doc_id, so each posting list is sorted and contains no duplicates.
+    A posting takes 12 bytes in the arrays instead of a tuple in a list, and nbytes tracks the
+    approximate memory used so a block can be flushed at a budget.
+    block[term] iterates the (doc_id, tf) postings of term.
+    Docs parsed with positions add a third list, of the 'p1:p2:...' positions strings of the postings,
+    and their postings are (doc_id, tf, positions).
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.nbytes = 0
 
-    Where each posting list is sorted and contains no duplicates
+    @profiling.timed('invert')
+    def add_doc(self, doc_vector):
+        profiling.count('postings', len(doc_vector))
+        for term, doc_id, tf, *positions in doc_vector:
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = (array.array('I'), array.array('d')) + (([],) if positions else ())
+                self.nbytes += BLOCK_TERM_BYTES + len(term)
+            postings[0].append(doc_id)
+            postings[1].append(tf)
+            self.nbytes += BLOCK_POSTING_BYTES
+            if positions:
+                postings[2].append(positions[0])
+                self.nbytes += sys.getsizeof(positions[0])
+
+    def __iter__(self):
+        return iter(self.postings)
+
+    def __getitem__(self, term):
+        return zip(*self.postings[term])
+
+    def __len__(self):
+        return len(self.postings)
+
+
+def build_block(args):
     """
-    temp_dict = {}
-    for t in block:
-        term, doc_id, tf = t
-        if term in temp_dict:
-            postings = temp_dict[term]
-            postings[doc_id] = tf
-        else:
-            postings = { doc_id : tf}
-            temp_dict[term] = postings
+    Tokenize and invert one block of files, args is (files, block_id, block_size, return_stems, positions)
+    Returns (block_index, stems), stems being the content of the stem cache if return_stems else None
+    Kept at module level so it can be sent to a worker process
+    """
+    files, block_id, block_size, return_stems, positions = args
+    block_index = CompactBlock()
+    file_idx = block_id * block_size
+    for filename in files[file_idx:file_idx + block_size]:
+        block_index.add_doc(parse_document(filename, positions))
+    return block_index, dict(analyzer.stem_cache.items()) if return_stems else None
 
-    # convert the postings (dict) into a postings list
-    result_dict = {}
-    for term in temp_dict:
-        result_dict[term] = []
-        for doc_id in temp_dict[term]:
-            tf = temp_dict[term][doc_id]
-            result_dict[term].append((doc_id, tf))
 
-    return result_dict
+def parse_documents(args):
+    """
+    Parse a chunk of files in a worker of fill_blocks, args is (files, positions, return_stems)
+    Returns (doc_vectors, stems), stems being the stem cache entries used by the chunk if return_stems
+    else None
+    """
+    files, positions, return_stems = args
+    lookups = analyzer.stem_cache.hits + analyzer.stem_cache.misses
+    doc_vectors = [parse_document(filename, positions) for filename in files]
+    if not return_stems:
+        return doc_vectors, None
+    # every word looked up by the chunk is among the most recently used entries, one per lookup at most
+    lookups = analyzer.stem_cache.hits + analyzer.stem_cache.misses - lookups
+    return doc_vectors, dict(analyzer.stem_cache.recent(lookups))
 
 
-def write_block_to_disk(index, term_to_id, next_term_id, block_id):
+def fill_blocks(files, memory_budget, pool=None, positions=False, return_stems=False):
     """
-    index: the inverted index for this block
+    Yield (block_index, stems) for blocks of consecutive files, each one flushed as soon as its
+    CompactBlock reaches memory_budget bytes, so memory use does not depend on document length
+    With a pool, the documents are tokenized by its workers, which send back the stems they used if
+    return_stems; stems is None otherwise
+    """
+    if pool:
+        chunks = pool.imap(parse_documents, [(files[i:i + DOCUMENT_CHUNK], positions, return_stems)
+                                             for i in range(0, len(files), DOCUMENT_CHUNK)])
+    else:
+        chunks = (([parse_document(filename, positions)], None) for filename in files)
+    block_index = CompactBlock()
+    stems = None
+    for doc_vectors, chunk_stems in chunks:
+        if chunk_stems:
+            stems = stems or {}
+            stems.update(chunk_stems)
+        for doc_vector in doc_vectors:
+            block_index.add_doc(doc_vector)
+            if block_index.nbytes >= memory_budget:
+                yield block_index, stems
+                block_index = CompactBlock()
+                stems = None
+    if len(block_index):
+        yield block_index, stems
+
+
+@profiling.timed('write')
+def write_block_to_disk(index, term_to_id, next_term_id, block_name):
+    """
+    index: the inverted index for this block, written to the file block_name
     """
-    block_name = "block{:03d}".format(block_id)
     f = open(block_name, 'w', newline='')
 
     term_ids = []
@@ -200,13 +580,13 @@ def write_block_to_disk(index, term_to_id, next_term_id, block_id):
         id_to_term[term_id] = term
 
     # Iterate the inverted index in increasing order of term_id
-    # write to the temp posting file: term_id doc_id,tf doc_id,tf ...
+    # write to the temp posting file: term_id doc_id,tf doc_id,tf ... (doc_id,tf,positions with positions)
     term_ids.sort() 
     for term_id in term_ids:
         term = id_to_term[term_id]
         new_posting = f'{term_id} '
         postings = index[term]
-        new_posting += ' '.join([f'{p[0]},{p[1]}' for p in postings])
+        new_posting += ' '.join([','.join(map(str, p)) for p in postings])
         f.write(new_posting)
         f.write('\n')
 
@@ -214,109 +594,110 @@ def write_block_to_disk(index, term_to_id, next_term_id, block_id):
     return next_term_id
 
 
-def merge_blocks(block_files, next_block_id):
-    n = len(block_files)
-    i = 0
-
-    while i < n:
-        k = min(2, n - i)
-        print(f'merging block {int(block_files[i][5:])} and {int(block_files[i + k - 1][5:])} to {next_block_id}')
-        merge_blocks_2_way(block_files, i, next_block_id)
-        next_block_id += 1
-        i += k
-
-    return next_block_id
-
-
-def merge_blocks_2_way(block_files, start_idx, next_block_id):
-    block_name = "block{:03d}".format(next_block_id)
-    f = open(block_name, 'w', newline='')
-
-    lineno = [1] * 2
-    if start_idx == len(block_files) - 1:
-        while lineno[0] >= 0:
-            new_posting = linecache.getline(block_files[start_idx], lineno[0])
-            if not new_posting:
-                lineno[0] = -1
-                break
-            lineno[0] += 1
-            f.write(new_posting)
-        os.remove(block_files[start_idx])
-        f.close()
-        return
+def merge_runs(block_files, buffer_size=MERGE_BUFFER_SIZE):
+    """
+    Merge groups of MERGE_FAN_IN consecutive block files into runs in the block format, pass after
+    pass, until at most MERGE_FAN_IN files are left, and return them in order
 
-    while True:
-        line0 = linecache.getline(block_files[start_idx], lineno[0])
-        if not line0:
-            lineno[0] = -1
-            break
-
-        line1 = linecache.getline(block_files[start_idx + 1], lineno[1])
-        if not line1:
-            lineno[1] = -1
-            break
-
-        term_id_0 = get_term_id(line0)
-        term_id_1 = get_term_id(line1)
-
-        if term_id_0 < term_id_1:
-            f.write(line0)
-            lineno[0] += 1
-        elif term_id_0 > term_id_1:
-            f.write(line1)
-            lineno[1] += 1
-        else:
-            term_id = term_id_0
-            posting0 = get_posting_str(line0)
-            posting1 = get_posting_str(line1)
-            merged_posting = merge(posting0, posting1)
-            k = -1
-            for mp in merged_posting:
-                cur_k = int(mp.split(',')[0])
-                if cur_k <= k:
-                    print("Incorrect merge order")
-                    print(f'{term_id} k:{k} curr:{cur_k}')
-                k = cur_k
-                    
-            posting_list = [str(term_id)] + merged_posting
-            new_posting = ' '.join([x for x in posting_list])
-            f.write(new_posting)
-            f.write('\n')
-            lineno[0] += 1
-            lineno[1] += 1
-
-    while lineno[0] >= 0:
-        new_posting = linecache.getline(block_files[start_idx], lineno[0])
-        if not new_posting:
-            lineno[0] = -1
-            break
-        lineno[0] += 1
-        f.write(new_posting)
+    A small memory budget can give thousands of blocks, more than the files a process may hold open
+    at once. A run is written next to its first block, and the merged files are deleted.
+    """
+    passes = 0
+    while len(block_files) > MERGE_FAN_IN:
+        runs = []
+        for i in range(0, len(block_files), MERGE_FAN_IN):
+            group = block_files[i:i + MERGE_FAN_IN]
+            if len(group) == 1:
+                runs.append(group[0])
+                continue
+            run_file = os.path.join(os.path.dirname(group[0]), f'run{passes}-{len(runs):03d}')
+            with open(run_file, 'w', newline='', buffering=max(io.DEFAULT_BUFFER_SIZE, buffer_size)) as f:
+                for term_id, posting_list in merge_blocks(group, buffer_size):
+                    f.write(f'{term_id} ' + ' '.join(posting_list) + '\n')
+            runs.append(run_file)
+        block_files = runs
+        passes += 1
+    return block_files
+
+
+def merge_blocks(block_files, buffer_size=MERGE_BUFFER_SIZE, remove=True):
+    """
+    Merge all block files in a single pass, yielding (term_id, ['doc_id,tf', ...]) in increasing term_id
+
+    Every block is sorted by term_id, so a heap on (term_id, block index) always holds the next
+    line of each block. Lines of the same term_id are popped in block order, and since blocks are
+    built in increasing order of doc_id their posting lists can simply be concatenated.
+    Each block is read through a buffer of buffer_size / number of blocks bytes, and every block is
+    open until the end, see merge_runs.
+    The block files are deleted once merged, unless remove is False.
+    """
+    print(f'merging {len(block_files)} blocks')
+    reader_buffer = max(io.DEFAULT_BUFFER_SIZE, buffer_size // max(1, len(block_files)))
+    readers = [open(block_file, 'r', newline='', buffering=reader_buffer) for block_file in block_files]
+
+    heap = []
+    for i, reader in enumerate(readers):
+        line = reader.readline()
+        if line:
+            heap.append((get_term_id(line), i, line))
+    heapq.heapify(heap)
+
+    while heap:
+        with profiling.timer('merge'):   # not around the yield, the consumer's time is its own
+            term_id = heap[0][0]
+            posting_list = []
+            while heap and heap[0][0] == term_id:
+                _, i, line = heapq.heappop(heap)
+                posting_list.extend(get_posting_str(line))
+                next_line = readers[i].readline()
+                if next_line:
+                    heapq.heappush(heap, (get_term_id(next_line), i, next_line))
+        yield term_id, posting_list
+
+    for reader, block_file in zip(readers, block_files):
+        reader.close()
+        if remove:
+            os.remove(block_file)
+
+
+@profiling.timed('reorder')
+def reorder_postings(block_files, doc_map_file, buffer_size=MERGE_BUFFER_SIZE):
+    """
+    Renumber the documents by recursive graph bisection (reorder.py) and return the merged postings
+    of the blocks with the new doc_ids, like merge_blocks
 
-    while lineno[1] >= 0:
-        new_posting = linecache.getline(block_files[start_idx + 1], lineno[1])
-        if not new_posting:
-            lineno[1] = -1
-            break
-        lineno[1] += 1
-        f.write(new_posting)
+    The blocks are merged twice: once to build the graph of the docs and of their terms found in more
+    than one doc, then again to renumber and sort every posting list. universal_id_set becomes 1..N
+    and the external doc_id (file name) of every new doc_id is written to doc_map_file.
+    """
+    doc_index = {doc_id: i for i, doc_id in enumerate(universal_id_set)}
+    doc_indexes = array.array('I')
+    term_indexes = array.array('I')
+    num_terms = 0
+    for _, posting_list in merge_blocks(block_files, buffer_size, remove=False):
+        if len(posting_list) < 2:   # a term of one doc costs the same anywhere
+            continue
+        doc_indexes.extend(doc_index[int(posting[:posting.index(',')])] for posting in posting_list)
+        term_indexes.extend([num_terms] * len(posting_list))
+        num_terms += 1
+    graph = reorder.DocGraph(doc_indexes, term_indexes, len(universal_id_set), num_terms)
+    order = reorder.bisection_order(graph, len(universal_id_set)).tolist()
 
-    os.remove(block_files[start_idx])
-    os.remove(block_files[start_idx + 1])
-    f.close()
+    external_ids = [universal_id_set[i] for i in order]
+    postings_format.write_doc_map(doc_map_file, external_ids)
+    new_ids = {doc_id: new_id for new_id, doc_id in enumerate(external_ids, 1)}
+    universal_id_set[:] = range(1, len(external_ids) + 1)
 
+    def renumbered_postings():
+        for term_id, posting_list in merge_blocks(block_files, buffer_size):
+            postings = []
+            for posting in posting_list:
+                doc_id, rest = posting.split(',', 1)   # rest: tf, or tf,positions
+                postings.append((new_ids[int(doc_id)], rest))
+            postings.sort()
+            yield term_id, [f'{doc_id},{rest}' for doc_id, rest in postings]
 
-def merge(x, y):
-    # get the first doc_id of each list
-    x_head = int(x[0].split(",")[0])
-    y_head = int(y[0].split(",")[0])
-    # append one list to the other as it is guaranteed
-    # that the head of one list is greater than the tail 
-    # of another list
-    if x_head < y_head:
-        return x + y
-    else:
-        return y + x
+    return renumbered_postings()
 
 
 def get_term_id(posting_line):
@@ -328,24 +709,6 @@ def get_term_id(posting_line):
     return int(term_id_str)
 
 
-def get_posting(posting_line):
-    posting_line = posting_line.strip()
-    i = 0
-    while posting_line[i] != ' ':
-        i += 1
-
-    i+=1 # skip past the whitespace
-    postings = []
-    for x in posting_line[i:].split(' '):
-        if not x:
-            continue
-        if ',' in x:
-            postings.append(int(x.split(',')[0]))
-        else:
-            postings.append(int(x))
-    return postings
-
-
 def get_posting_str(posting_line):
     posting_line = posting_line.strip()
     i = 0
@@ -355,31 +718,119 @@ def get_posting_str(posting_line):
     return posting_line[i:].split(' ')
 
 
-def add_skip_pointers(out_postings):
-    temp_filename = 'postings_skip_ptrs.txt'
-    temp_file = open(temp_filename, 'w', newline='')
+def write_postings(merged_postings, out_postings, weight_format=None, buffer_size=MERGE_BUFFER_SIZE,
+                   impact_file=None, tier=None, positions_file=None, tier_block_file=TIER_BLOCK):
+    """
+    Writes the final postings file while the blocks are being merged
+
+    merged_postings yields (term_id, ['doc_id,tf', ...]) in increasing term_id. Each posting list is
+    written with its skip pointers (text) or as a binary record when weight_format is given, and its
+    dictionary entry is computed on the fly, so the merged postings are never read back.
+    The posting list of the universal term is appended last. If impact_file is given, the impact
+    ordered copy of every posting list but the universal one is written there as well.
+    tier: (prune_weight, max_df), the postings selected by split_tier are written to tier_block_file
+    instead, while the dictionary entry keeps the idf and max_weight of the whole list.
+    Postings of the form 'doc_id,tf,positions' are written without their positions, which go to
+    positions_file if given, for the whole list whatever the tier.
+
+    Returns a list of (term_id, idf, offset, length, doc_freq, max_weight) indexed by term_id, where
+    offset and length are the position and number of bytes of the posting list (text: without term_id
+    and newline) and max_weight is its largest lnc weight as stored, an upper bound used for dynamic
+    pruning
+    """
+    collection_size = len(universal_id_set)
+    entries = []
+    f = open(out_postings, 'wb', buffering=max(io.DEFAULT_BUFFER_SIZE, buffer_size))
+    offset = 0
+    if weight_format is not None:
+        offset = f.write(postings_format.encode_header(weight_format))
+    impact = postings_format.ImpactWriter(impact_file) if impact_file else None
+    positions = postings_format.PositionsWriter(positions_file) if positions_file else None
+    tier_block = open(tier_block_file, 'w', newline='') if tier else None
+
+    @profiling.timed('postings')
+    def write_posting_list(term_id, posting_list, universal=False):
+        nonlocal offset
+        doc_freq = len(posting_list)
+        doc_ids = []
+        weights = []
+        doc_positions = []
+        for p in posting_list:
+            doc_id, tf, *rest = p.split(',')
+            doc_ids.append(int(doc_id))
+            weights.append(float(tf))
+            if rest:
+                doc_positions.append(rest[0])
+        if doc_positions:
+            posting_list = [p[:p.rindex(',')] for p in posting_list]
+            if positions:
+                positions.add(doc_ids, [[int(x) for x in p.split(':')] for p in doc_positions])
+        idf = math.log(collection_size / doc_freq)
+        max_weight = max(weights)
+        if weight_format is not None:   # the bound of the weights as search.py decodes them
+            max_weight = postings_format.stored_weight(max_weight, weight_format)
+
+        if tier and not universal:
+            kept = split_tier(weights, *tier)
+            if len(kept) < doc_freq:
+                kept_set = set(kept)
+                moved = [posting for i, posting in enumerate(posting_list) if i not in kept_set]
+                tier_block.write(f'{term_id} ' + ' '.join(moved) + '\n')
+                posting_list = [posting_list[i] for i in kept]
+                doc_ids = [doc_ids[i] for i in kept]
+                weights = [weights[i] for i in kept]
+
+        if weight_format is None:
+            if universal:   # the universal posting list only holds doc_ids
+                posting_list = [str(x) for x in doc_ids]
+            term_id_str = f'{term_id} '.encode()
+            data = augment_postings(posting_list).encode()
+            f.write(term_id_str)
+            f.write(data)
+            f.write(b'\n')
+            start = offset + len(term_id_str)
+            offset = start + len(data) + 1
+        else:
+            data = postings_format.encode_postings(doc_ids, weights, weight_format)
+            f.write(data)
+            start = offset
+            offset += len(data)
+        profiling.count('postings_bytes', len(data))
+        if impact and not universal:
+            impact.add(doc_ids, weights)
+        entries.append((term_id, idf, start, len(data), len(doc_ids), max_weight))
+
+    for term_id, posting_list in merged_postings:
+        write_posting_list(term_id, posting_list)
 
-    lineno = 1
-    line = linecache.getline(out_postings, lineno)
-    while line:
-        augmented_line = augment_line(line)
-        temp_file.write(augmented_line)
-        temp_file.write('\n')
-        lineno += 1
-        line = linecache.getline(out_postings, lineno)
+    # binary records store the universal doc_ids with a weight of 0
+    write_posting_list(len(entries), [f'{x},0' for x in universal_id_set], universal=True)
+
+    f.close()
+    if impact:
+        impact.close()
+    if positions:
+        positions.close()
+    if tier_block:
+        tier_block.close()
+    return entries
 
-    universal_term_id = lineno - 1
-    universal_id_line = f'{universal_term_id} ' + ' '.join([str(x) for x in universal_id_set])
-    universal_id_aug_line = augment_line(universal_id_line)
-    temp_file.write(universal_id_aug_line)
-    temp_file.write('\n')
 
-    temp_file.close()
-    os.remove(out_postings)
-    os.rename(temp_filename, out_postings)
+def split_tier(weights, prune_weight=0.0, max_df=0):
+    """
+    Returns the sorted indexes of the postings kept in the primary tier: those weighing at least
+    prune_weight times the largest weight, and only the max_df heaviest of them if max_df is set
+    (on equal weights, the smaller doc_ids), so the largest weight is always kept
+    """
+    threshold = prune_weight * max(weights)
+    kept = [i for i, weight in enumerate(weights) if weight >= threshold]
+    if max_df and len(kept) > max_df:
+        kept = sorted(sorted(kept, key=lambda i: -weights[i])[:max_df])
+    return kept
 
 
-def augment_line(line):
+@profiling.timed('skip')
+def augment_postings(posting_list):
     """
     Add skip pointer to a posting list and return its string representation
 
@@ -390,87 +841,156 @@ def augment_line(line):
 
     It indicate to the searcher to skip 3 whitespace to get to the next number
     """
-    term_id = get_term_id(line)
-    posting_list = get_posting_str(line)
     n = len(posting_list)
     k = math.floor(n ** 0.5)  # k is the skip distance
-    new_line = f'{term_id} '
-    for i in range(n):
-        new_line += posting_list[i]
-        if k > 1 and i % k == 0 and i + k < n:
-            skip_offset = (k - 1) + sum([len(str(x)) for x in posting_list[i + 1:i + k]])
-            new_line += f',{skip_offset}'
-        if i < n - 1:
-            new_line += ' '
-    return new_line
+    if k <= 1:
+        return ' '.join(posting_list)
 
+    # prefix_len[i] is the total length of the first i postings
+    prefix_len = [0]
+    for posting in posting_list:
+        prefix_len.append(prefix_len[-1] + len(posting))
 
-def write_dictionary(term_to_id, out_dict, out_postings):
+    augmented = list(posting_list)
+    for i in range(0, n - k, k):
+        skip_offset = (k - 1) + prefix_len[i + k] - prefix_len[i + 1]
+        augmented[i] = f'{posting_list[i]},{skip_offset}'
+    return ' '.join(augmented)
+
+
+@profiling.timed('dictionary')
+def write_dictionary(term_to_id, out_dict, dictionary_entries, binary_dict=False):
     """
     Generates the final dictionary and write it to 'dictionary.txt'
     dict : {
-        'term1' : (term_id, idf, offset),
-        'term2' : (term_id, idf, offset),
+        'term1' : (term_id, idf, offset, length, doc_freq, max_weight),
+        'term2' : (term_id, idf, offset, length, doc_freq, max_weight),
         ...
     }
+    If binary_dict is set, the dictionary is written as the sorted binary lexicon of lexicon.py
     """
-    final_dict = {}  # mapping of terms to (term_id, idf, offset)
+    final_dict = {}  # mapping of terms to (term_id, idf, offset, length, doc_freq, max_weight)
     n = len(term_to_id) # number of terms
     term_to_id[UNIVERSAL] = n
-    collection_size = len(universal_id_set)
-
-    line_offsets_and_doc_freq = []
-    offset = 0
-    lineno = 1
-    linecache.clearcache()
-    line = linecache.getline(out_postings, lineno)
-    while line:
-        term_id = get_term_id(line)
-        doc_freq = len(get_posting(line))
-        idf = math.log(collection_size / doc_freq)
-        line_offsets_and_doc_freq.append((term_id, idf, offset + get_term_id_len(term_id)))
-        offset += len(line)
-        lineno += 1
-        line = linecache.getline(out_postings, lineno)
 
     for term in term_to_id:
         term_id = term_to_id[term]
-        final_dict[term] = line_offsets_and_doc_freq[term_id]
+        final_dict[term] = dictionary_entries[term_id]
+
+    if binary_dict:
+        lexicon.write_lexicon(out_dict, final_dict)
+        return
 
     out_dict_file = open(out_dict, 'w')
     json.dump(final_dict, out_dict_file, sort_keys=False, indent=2)
     out_dict_file.close()
 
 
-def get_term_id_len(term_id):
-    """
-    Returns the length (number of bytes) of the term_id when in str representation
-    '1 ' --> 2
-    '24 ' --> 3
-    """
-    return len(str(term_id)) + 1
-
-
-input_directory = output_file_dictionary = output_file_postings = None
-
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-
-for o, a in opts:
-    if o == '-i':  # input directory
-        input_directory = a
-    elif o == '-d':  # dictionary file
-        output_file_dictionary = a
-    elif o == '-p':  # postings file
-        output_file_postings = a
+if __name__ == '__main__':
+    input_directory = output_file_dictionary = output_file_postings = None
+    binary_postings = quantize_weights = binary_dictionary = impact_postings = False
+    prune_weight = tier_df = 0.0
+    reorder_docs = positions = False
+    workers = 1
+    merge_buffer = MERGE_BUFFER_SIZE
+    memory_budget = 0
+    persist_stems = False
+    command = None  # None builds a new index, or 'add', 'delete', 'compact' on a segmented index
+    deleted_doc_ids = []
+    num_shards = 0
+    profile_file = None
+    shard_by = 'range'
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:b', ['quantize', 'binary-dict', 'workers=', 'merge-buffer=',
+                                                             'stem-cache', 'add', 'delete=', 'compact',
+                                                             'shards=', 'shard-by=', 'memory-budget=',
+                                                             'profile=', 'impact', 'prune-weight=', 'tier-df=',
+                                                             'reorder', 'positions'])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-i':  # input directory
+            input_directory = a
+        elif o == '-d':  # dictionary file
+            output_file_dictionary = a
+        elif o == '-p':  # postings file
+            output_file_postings = a
+        elif o == '-b':  # binary postings file
+            binary_postings = True
+        elif o == '--quantize':  # 16 bit weights in the binary postings file
+            quantize_weights = True
+        elif o == '--binary-dict':  # binary sorted array dictionary file
+            binary_dictionary = True
+        elif o == '--workers':  # number of processes building blocks
+            workers = int(a)
+        elif o == '--merge-buffer':  # bytes of read buffers used by the block merge
+            merge_buffer = int(a)
+        elif o == '--memory-budget':  # bytes of postings held in memory before a block is flushed
+            memory_budget = int(a)
+        elif o == '--profile':  # write the time spent in each indexing phase as JSON
+            profile_file = a
+        elif o == '--impact':  # impact ordered copy of the postings for score at a time search
+            impact_postings = True
+        elif o == '--prune-weight':  # fraction of a term's largest weight below which postings go to the tier
+            prune_weight = float(a)
+        elif o == '--tier-df':  # fraction of the docs a posting list is cut to, the rest goes to the tier
+            tier_df = float(a)
+        elif o == '--reorder':  # renumber similar documents next to each other
+            reorder_docs = True
+        elif o == '--positions':  # positions of the terms in the docs, for phrase and proximity queries
+            positions = True
+        elif o == '--stem-cache':  # persist the stem cache next to the dictionary
+            persist_stems = True
+        elif o == '--add':  # index the documents into a new segment
+            command = 'add'
+        elif o == '--delete':  # comma separated doc_ids to delete
+            command = 'delete'
+            deleted_doc_ids = [int(doc_id) for doc_id in a.split(',')]
+        elif o == '--compact':  # merge all segments into one
+            command = 'compact'
+        elif o == '--shards':  # number of shards to partition the documents into
+            num_shards = int(a)
+        elif o == '--shard-by':  # range or hash partitioning of the doc_ids
+            shard_by = a
+        else:
+            assert False, "unhandled option"
+
+    if output_file_dictionary == None:
+        usage()
+        sys.exit(2)
+    if profile_file:
+        # phases run by --workers processes are not collected
+        profiling.enable()
+    if command == 'delete':
+        delete_documents(output_file_dictionary, deleted_doc_ids)
+        sys.exit(0)
+    if output_file_postings == None:
+        usage()
+        sys.exit(2)
+    if command == 'compact':
+        compact_segments(output_file_dictionary, output_file_postings, merge_buffer)
+        sys.exit(0)
+    if input_directory == None or shard_by not in SHARD_BY:
+        usage()
+        sys.exit(2)
+    if reorder_docs and reorder.np is None:
+        print('--reorder requires numpy')
+        sys.exit(2)
+
+    if command == 'add':
+        add_documents(input_directory, output_file_dictionary, output_file_postings, binary_postings,
+                      quantize_weights, binary_dictionary, workers, merge_buffer, persist_stems, memory_budget)
+    elif num_shards > 1:
+        build_shards(input_directory, output_file_dictionary, output_file_postings, num_shards, shard_by,
+                     binary_postings, quantize_weights, binary_dictionary, workers, merge_buffer, persist_stems,
+                     memory_budget)
     else:
-        assert False, "unhandled option"
-
-if input_directory == None or output_file_postings == None or output_file_dictionary == None:
-    usage()
-    sys.exit(2)
-
-build_index(input_directory, output_file_dictionary, output_file_postings)
+        build_index(input_directory, output_file_dictionary, output_file_postings, binary_postings,
+                    quantize_weights, binary_dictionary, workers, merge_buffer, persist_stems,
+                    memory_budget=memory_budget, impact=impact_postings, prune_weight=prune_weight,
+                    tier_df=tier_df, reorder_docs=reorder_docs, positions=positions)
+    if profile_file:
+        profiling.write_summary(profile_file, {'stem_cache': analyzer.stem_cache.stats()})
@@ -0,0 +1,149 @@
+"""
+Compact binary dictionary (lexicon) shared by index.py and search.py
+
+The file starts with a 16 byte header
+    MAGIC (4 bytes) | version (1 byte) | reserved (3 bytes) | num_terms (uint32) | blob_len (uint32)
+
+followed by parallel arrays over the terms sorted by their utf-8 bytes (little endian)
+    idf             float64 x num_terms
+    max_weights     float64 x num_terms     largest lnc weight in the posting list
+    offsets         uint64  x num_terms     byte offset of the posting list in postings.txt
+    term_offsets    uint32  x (num_terms + 1)   start of each term in the blob
+    term_ids        uint32  x num_terms
+    lengths         uint32  x num_terms     number of bytes of the posting list
+    doc_freqs       uint32  x num_terms
+    blob            the sorted terms concatenated
+
+The file is memory mapped and terms are found by binary search over the blob, so nothing
+has to be parsed before the first lookup.
+"""
+import array
+import json
+import mmap
+import struct
+import sys
+
+MAGIC = b'VSML'
+VERSION = 2
+HEADER_FORMAT = '<4sB3xII'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+
+def write_lexicon(out_dict, dictionary):
+    """
+    dictionary: mapping of term to (term_id, idf, offset, length, doc_freq, max_weight)
+    """
+    encoded = sorted((term.encode('utf-8'), entry) for term, entry in dictionary.items())
+    n = len(encoded)
+
+    idf = array.array('d', [entry[1] for _, entry in encoded])
+    max_weights = array.array('d', [entry[5] for _, entry in encoded])
+    offsets = array.array('Q', [entry[2] for _, entry in encoded])
+    term_ids = array.array('I', [entry[0] for _, entry in encoded])
+    lengths = array.array('I', [entry[3] for _, entry in encoded])
+    doc_freqs = array.array('I', [entry[4] for _, entry in encoded])
+    term_offsets = array.array('I', [0] * (n + 1))
+    blob = bytearray()
+    for i, (term, _) in enumerate(encoded):
+        blob += term
+        term_offsets[i + 1] = len(blob)
+
+    with open(out_dict, 'wb') as f:
+        f.write(struct.pack(HEADER_FORMAT, MAGIC, VERSION, n, len(blob)))
+        for arr in (idf, max_weights, offsets, term_offsets, term_ids, lengths, doc_freqs):
+            if sys.byteorder == 'big':
+                arr.byteswap()
+            f.write(arr.tobytes())
+        f.write(blob)
+
+
+class Lexicon:
+    """
+    Read only view of a binary dictionary, usable in place of the json dictionary:
+    'term in lexicon' and lexicon[term] -> (term_id, idf, offset, length, doc_freq, max_weight)
+    """
+
+    def __init__(self, dict_file):
+        self.file = open(dict_file, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        magic, version, n, blob_len = struct.unpack_from(HEADER_FORMAT, self.mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{dict_file} is not a binary dictionary')
+        self.num_terms = n
+
+        pos = HEADER_SIZE
+        arrays = []
+        for code, count in (('d', n), ('d', n), ('Q', n), ('I', n + 1), ('I', n), ('I', n), ('I', n)):
+            end = pos + count * struct.calcsize(code)
+            arrays.append(self.view[pos:end].cast(code))
+            pos = end
+        (self.idf, self.max_weights, self.offsets, self.term_offsets,
+         self.term_ids, self.lengths, self.doc_freqs) = arrays
+        self.blob = self.view[pos:pos + blob_len]
+
+    def term_at(self, i):
+        return bytes(self.blob[self.term_offsets[i]:self.term_offsets[i + 1]])
+
+    def entry_at(self, i):
+        return (self.term_ids[i], self.idf[i], self.offsets[i], self.lengths[i], self.doc_freqs[i],
+                self.max_weights[i])
+
+    def find(self, term):
+        """
+        Returns the index of term in the sorted arrays, or -1 if it is not in the dictionary
+        """
+        key = term.encode('utf-8')
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_terms and self.term_at(lo) == key:
+            return lo
+        return -1
+
+    def __contains__(self, term):
+        return self.find(term) >= 0
+
+    def __getitem__(self, term):
+        i = self.find(term)
+        if i < 0:
+            raise KeyError(term)
+        return self.entry_at(i)
+
+    def get(self, term, default=None):
+        i = self.find(term)
+        return self.entry_at(i) if i >= 0 else default
+
+    def __len__(self):
+        return self.num_terms
+
+    def __iter__(self):
+        for i in range(self.num_terms):
+            yield self.term_at(i).decode('utf-8')
+
+    def items(self):
+        for i in range(self.num_terms):
+            yield self.term_at(i).decode('utf-8'), self.entry_at(i)
+
+    def close(self):
+        for view in (self.idf, self.max_weights, self.offsets, self.term_offsets, self.term_ids, self.lengths,
+                     self.doc_freqs, self.blob, self.view):
+            view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+def load_dictionary(dict_file):
+    """
+    Load dictionary.txt, which is either the binary lexicon or the json dictionary
+    """
+    with open(dict_file, 'rb') as f:
+        magic = f.read(len(MAGIC))
+    if magic == MAGIC:
+        return Lexicon(dict_file)
+    with open(dict_file, 'r') as f:
+        return json.load(f)
@@ -0,0 +1,604 @@
+"""
+Binary postings format shared by index.py and search.py
+
+The file starts with an 8 byte header
+    MAGIC (4 bytes) | version (1 byte) | weight format (1 byte) | reserved (2 bytes)
+
+followed by one record per term. The byte offset kept in the dictionary points
+at the start of the record, which is laid out as
+    varint record_len                       number of bytes after this varint
+    varint doc_freq
+    varint num_skips
+    num_skips x (varint doc_id, varint pos)  skip table, pos is relative to the doc section
+    (num_skips + 1) weights                 largest weight of each block (float32 or uint16)
+    varint doc_len                          number of bytes in the doc section
+    doc section                             doc_freq varints: first doc_id, then gaps
+    weight section                          doc_freq float32 or uint16 (little endian)
+
+Skip entries are placed every k = floor(sqrt(doc_freq)) postings, the same
+distance used by the text format, and point at postings k, 2k, 3k, ...
+They split the list into num_skips + 1 blocks, each with its largest weight
+stored in the header as a score upper bound for dynamic pruning.
+
+index.py --impact also writes an impact ordered copy of every posting list to
+postings.txt.impact, for score at a time evaluation. Each posting's lnc weight
+is quantized to an impact level in 1..IMPACT_LEVELS (its ceiling over [0, 1]),
+and the postings of a term are grouped into one segment per level, highest
+level first. The file starts with an 8 byte header
+    IMPACT_MAGIC (4 bytes) | version (1 byte) | reserved (3 bytes)
+
+followed by one record per term
+    varint num_segments
+    num_segments x (varint level, varint count, varint doc_len,
+                    doc section, count float32 weights)
+
+then the table of record offsets indexed by term_id (uint64, 8 byte aligned)
+and a 16 byte footer: table offset (uint64) | number of terms (uint64).
+Doc sections are gap encoded like the records above, the weights are float32
+weights (ranks match the text index; scores to ~1e-7), so a query evaluated over
+every segment scores like the doc_id ordered postings.
+
+index.py --reorder renumbers the documents 1..N before writing the postings and
+writes postings.txt.docs, the external doc_id (file name) of each internal one:
+    DOC_MAP_MAGIC (4 bytes) | version (1 byte) | reserved (3 bytes)
+    uint32 x (N + 1)        external doc_id of internal doc_id i, 0 for i = 0
+
+index.py --positions writes the token positions of every term in every doc to
+postings.txt.pos, for the phrase and proximity operators of search.py. After an
+8 byte header POSITIONS_MAGIC (4 bytes) | version (1 byte) | reserved (3 bytes)
+comes one record per term
+    varint doc_freq
+    varint num_skips
+    num_skips x (varint doc_id, varint pos)  last doc_id before the block, pos relative to the doc section
+    doc section                             per doc: varint doc_id gap, varint positions_len,
+                                            positions_len bytes of varints: first position, then gaps
+then the record offset table and footer laid out as in the impact file. Skip
+entries point at postings k, 2k, ... (k = skip_distance(doc_freq)), so the
+positions of a few candidate docs are found without decoding the whole list.
+"""
+import array
+import bisect
+import collections
+import math
+import mmap
+import os
+import struct
+import sys
+
+try:
+    import numpy as np
+except ImportError:  # numpy is only needed for the array accessors
+    np = None
+
+MAGIC = b'VSMP'
+VERSION = 2
+HEADER_SIZE = 8
+
+WEIGHT_FLOAT32 = 0  # lnc weight stored as a 4 byte float
+WEIGHT_UINT16 = 1   # lnc weight quantized to 16 bits over [0, 1]
+
+IMPACT_MAGIC = b'VSMI'
+IMPACT_SUFFIX = '.impact'  # appended to the postings file name
+IMPACT_LEVELS = 32  # impact levels a weight is quantized to, and the most segments of a term
+RECORD_FOOTER = '<QQ'  # table offset and number of terms, ending the impact and positions files
+
+DOC_MAP_MAGIC = b'VSMD'
+DOC_MAP_SUFFIX = '.docs'  # appended to the postings file name
+
+POSITIONS_MAGIC = b'VSMX'
+POSITIONS_SUFFIX = '.pos'  # appended to the postings file name
+
+TMP_SUFFIX = '.tmp'  # index files being written by index.py, renamed once the index is complete
+
+WEIGHT_WIDTH = {WEIGHT_FLOAT32: 4, WEIGHT_UINT16: 2}
+WEIGHT_STRUCT_CODE = {WEIGHT_FLOAT32: 'f', WEIGHT_UINT16: 'H'}
+QUANTIZE_SCALE = 65535
+
+
+def encode_header(weight_format):
+    return MAGIC + struct.pack('<BBH', VERSION, weight_format, 0)
+
+
+def decode_header(buf):
+    """
+    Returns the weight format of a binary postings file,
+    or None if buf does not start with the binary postings header (i.e. text postings)
+    """
+    if len(buf) < HEADER_SIZE or bytes(buf[:4]) != MAGIC:
+        return None
+    version, weight_format, _ = struct.unpack_from('<BBH', buf, 4)
+    if version != VERSION or weight_format not in WEIGHT_WIDTH:
+        raise ValueError(f'unsupported postings format (version {version}, weights {weight_format})')
+    return weight_format
+
+
+def encode_varint(n, out):
+    """
+    Append n to the bytearray out as an unsigned LEB128 varint
+    """
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varint(buf, pos):
+    """
+    Returns (value, position after the varint)
+    """
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def skip_distance(doc_freq):
+    k = int(doc_freq ** 0.5)
+    return k if k > 1 else 0
+
+
+def encode_postings(doc_ids, weights, weight_format):
+    """
+    Encode a sorted posting list into a binary record (see module docstring)
+    """
+    n = len(doc_ids)
+    k = skip_distance(n)
+    docs = bytearray()
+    skips = []
+    prev = 0
+    for i, doc_id in enumerate(doc_ids):
+        if k and i and i % k == 0:
+            skips.append((doc_id, len(docs)))
+        encode_varint(doc_id - prev, docs)
+        prev = doc_id
+
+    if weight_format == WEIGHT_UINT16:
+        weights = [min(QUANTIZE_SCALE, max(0, round(w * QUANTIZE_SCALE))) for w in weights]
+    code = WEIGHT_STRUCT_CODE[weight_format]
+    weight_bytes = struct.pack(f'<{n}{code}', *weights)
+    block_size = k if k else n
+    block_max = [max(weights[i:i + block_size]) for i in range(0, n, block_size)]
+
+    body = bytearray()
+    encode_varint(n, body)
+    encode_varint(len(skips), body)
+    for doc_id, pos in skips:
+        encode_varint(doc_id, body)
+        encode_varint(pos, body)
+    body += struct.pack(f'<{len(block_max)}{code}', *block_max)
+    encode_varint(len(docs), body)
+    body += docs
+    body += weight_bytes
+
+    record = bytearray()
+    encode_varint(len(body), record)
+    return bytes(record + body)
+
+
+# View over one term's record. skips, docs and weights are slices of the buffer the
+# record was parsed from, so nothing is copied until the postings are decoded.
+TermPostings = collections.namedtuple('TermPostings',
+                                      ['doc_freq', 'num_skips', 'skips', 'block_max', 'docs', 'weights'])
+
+
+def parse_record(buf, pos, weight_format):
+    """
+    Parse the header of the record starting at buf[pos] and return a TermPostings view
+    buf must be a memoryview of unsigned bytes
+    """
+    _, pos = decode_varint(buf, pos)
+    n, pos = decode_varint(buf, pos)
+    num_skips, pos = decode_varint(buf, pos)
+    skip_pos = pos
+    for _ in range(2 * num_skips):
+        while buf[pos] >= 0x80:
+            pos += 1
+        pos += 1
+    skips = buf[skip_pos:pos]
+    width = WEIGHT_WIDTH[weight_format]
+    code = WEIGHT_STRUCT_CODE[weight_format]
+    block_max = buf[pos:pos + (num_skips + 1) * width].cast(code)
+    pos += (num_skips + 1) * width
+    doc_len, pos = decode_varint(buf, pos)
+
+    weight_pos = pos + doc_len
+    weights = buf[weight_pos:weight_pos + n * width].cast(code)
+    return TermPostings(n, num_skips, skips, block_max, buf[pos:weight_pos], weights)
+
+
+def decode_skips(term_postings):
+    """
+    Returns the skip table of a TermPostings as a list of (doc_id, pos in the doc section)
+    """
+    skips = []
+    pos = 0
+    for _ in range(term_postings.num_skips):
+        doc_id, pos = decode_varint(term_postings.skips, pos)
+        doc_pos, pos = decode_varint(term_postings.skips, pos)
+        skips.append((doc_id, doc_pos))
+    return skips
+
+
+def stored_weight(weight, weight_format):
+    """
+    Returns weight as it is decoded once encoded in weight_format: rounded to float32, or quantized
+    to 16 bits. Stored weights keep the order of the weights, so the stored largest weight of a
+    posting list is the largest of its stored weights.
+    """
+    if weight_format == WEIGHT_UINT16:
+        return min(QUANTIZE_SCALE, max(0, round(weight * QUANTIZE_SCALE))) / QUANTIZE_SCALE
+    return struct.unpack('<f', struct.pack('<f', weight))[0]
+
+
+def decode_weights(weights, weight_format):
+    """
+    Returns a list of float weights from a (slice of) the weights or block_max of a TermPostings
+    """
+    if weight_format == WEIGHT_UINT16:
+        return [w / QUANTIZE_SCALE for w in weights]
+    return weights.tolist()
+
+
+def decode_postings(buf, pos, weight_format):
+    """
+    Decode the record starting at buf[pos] into [[doc_id, weight], ...]
+    """
+    term_postings = parse_record(memoryview(buf).cast('B'), pos, weight_format)
+    docs = term_postings.docs
+    weights = decode_weights(term_postings.weights, weight_format)
+
+    postings = []
+    doc_id = 0
+    pos = 0
+    for w in weights:
+        gap, pos = decode_varint(docs, pos)
+        doc_id += gap
+        postings.append([doc_id, w])
+    return postings
+
+
+def decode_doc_ids_array(docs):
+    """
+    Vectorized decode of a doc section (memoryview of varint gaps) into an int64 numpy array of doc_ids
+    """
+    b = np.frombuffer(docs, dtype=np.uint8)
+    ends = np.flatnonzero(b < 0x80)
+    if len(ends) == len(b):  # every gap fits in one byte
+        gaps = b.astype(np.int64)
+    else:
+        starts = np.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+        shift = (np.arange(len(b)) - starts[group]) * 7
+        values = (b & 0x7f).astype(np.int64) << shift
+        gaps = np.bincount(group, weights=values, minlength=len(ends)).astype(np.int64)
+    return np.cumsum(gaps)
+
+
+def decode_weights_array(term_postings, weight_format):
+    """
+    Returns the weights of a TermPostings as a float64 numpy array
+    """
+    dtype = '<f4' if weight_format == WEIGHT_FLOAT32 else '<u2'
+    weights = np.frombuffer(term_postings.weights.cast('B'), dtype=dtype).astype(np.float64)
+    if weight_format == WEIGHT_UINT16:
+        weights /= QUANTIZE_SCALE
+    return weights
+
+
+class PostingsReader:
+    """
+    Read only, memory mapped view of a text or binary postings file
+
+    The file is mapped once and every lookup returns slices of the mapping, so hot
+    posting lists are served from the page cache without reading them into new buffers.
+    weight_format is None for text postings.
+    Weights of binary records are cast in native byte order, which matches the
+    little endian files written by index.py on the platforms we run on.
+    impact is the ImpactReader of the impact ordered copy written by index.py --impact,
+    or None. positions is the PositionsReader of index.py --positions, or None.
+    doc_map maps the doc_ids of an index written by index.py --reorder to the external
+    ones (read_doc_map), or is None. tier is the segments.TieredIndex of the secondary
+    tier of index.py --prune-weight and --tier-df, set by search.load_index, or None.
+    """
+
+    def __init__(self, postings_file):
+        self.file = open(postings_file, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        self.weight_format = decode_header(self.view)
+        impact_file = postings_file + IMPACT_SUFFIX
+        self.impact = ImpactReader(impact_file) if os.path.exists(impact_file) else None
+        doc_map_file = postings_file + DOC_MAP_SUFFIX
+        self.doc_map = read_doc_map(doc_map_file) if os.path.exists(doc_map_file) else None
+        positions_file = postings_file + POSITIONS_SUFFIX
+        self.positions = PositionsReader(positions_file) if os.path.exists(positions_file) else None
+        self.tier = None
+
+    def line(self, offset):
+        """
+        Returns the text posting list starting at offset, without the trailing newline
+        """
+        end = self.mmap.find(b'\n', offset)
+        if end < 0:
+            end = len(self.mmap)
+        return self.view[offset:end]
+
+    def record(self, offset):
+        """
+        Returns the TermPostings view of the binary record starting at offset
+        """
+        return parse_record(self.view, offset, self.weight_format)
+
+    def postings(self, offset):
+        """
+        Decode the binary record at offset into [[doc_id, weight], ...]
+        """
+        return decode_postings(self.view, offset, self.weight_format)
+
+    def arrays(self, offset):
+        """
+        Decode the binary record at offset into numpy arrays (doc_ids int64, weights float64)
+        """
+        term_postings = self.record(offset)
+        return decode_doc_ids_array(term_postings.docs), decode_weights_array(term_postings, self.weight_format)
+
+    def close(self):
+        if self.impact:
+            self.impact.close()
+        if self.positions:
+            self.positions.close()
+        if self.tier:
+            self.tier.close()
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+def impact_level(weight):
+    return min(IMPACT_LEVELS, max(1, math.ceil(weight * IMPACT_LEVELS)))
+
+
+def encode_impact_postings(doc_ids, weights):
+    """
+    Encode a sorted posting list into an impact ordered record (see module docstring)
+    """
+    levels = {}
+    for doc_id, weight in zip(doc_ids, weights):
+        level = levels.setdefault(impact_level(weight), ([], []))
+        level[0].append(doc_id)
+        level[1].append(weight)
+
+    record = bytearray()
+    encode_varint(len(levels), record)
+    for level in sorted(levels, reverse=True):
+        level_doc_ids, level_weights = levels[level]
+        docs = bytearray()
+        prev = 0
+        for doc_id in level_doc_ids:
+            encode_varint(doc_id - prev, docs)
+            prev = doc_id
+        encode_varint(level, record)
+        encode_varint(len(level_doc_ids), record)
+        encode_varint(len(docs), record)
+        record += docs
+        record += struct.pack(f'<{len(level_weights)}f', *level_weights)
+    return bytes(record)
+
+
+class TermRecordWriter:
+    """
+    Writes a file of one record per term added in increasing term_id from 0, followed by the table
+    of their offsets (the impact and positions files)
+    """
+
+    def __init__(self, path, magic):
+        self.file = open(path, 'wb')
+        self.offset = self.file.write(magic + struct.pack('<B3x', VERSION))
+        self.offsets = []
+
+    def add_record(self, data):
+        self.offsets.append(self.offset)
+        self.offset += self.file.write(data)
+
+    def close(self):
+        padding = -self.offset % 8
+        self.file.write(bytes(padding))
+        table_offset = self.offset + padding
+        self.file.write(struct.pack(f'<{len(self.offsets)}Q', *self.offsets))
+        self.file.write(struct.pack(RECORD_FOOTER, table_offset, len(self.offsets)))
+        self.file.close()
+
+
+class TermRecordReader:
+    """
+    Read only, memory mapped view of a file written by TermRecordWriter
+    offsets[term_id] is the position of the record of term_id in view
+    """
+
+    def __init__(self, path, magic, description):
+        self.file = open(path, 'rb')
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        if bytes(self.view[:4]) != magic or self.view[4] != VERSION:
+            raise ValueError(f'{path} is not {description}')
+        table_offset, num_terms = struct.unpack_from(RECORD_FOOTER, self.mmap,
+                                                     len(self.mmap) - struct.calcsize(RECORD_FOOTER))
+        self.offsets = self.view[table_offset:table_offset + 8 * num_terms].cast('Q')
+
+    def close(self):
+        self.offsets.release()
+        self.view.release()
+        self.mmap.close()
+        self.file.close()
+
+
+class ImpactWriter(TermRecordWriter):
+    """
+    Writes postings.txt.impact, one record per term added in increasing term_id from 0
+    """
+
+    def __init__(self, impact_file):
+        super().__init__(impact_file, IMPACT_MAGIC)
+
+    def add(self, doc_ids, weights):
+        self.add_record(encode_impact_postings(doc_ids, weights))
+
+
+class ImpactReader(TermRecordReader):
+    """
+    Read only, memory mapped view of postings.txt.impact
+    """
+
+    def __init__(self, impact_file):
+        super().__init__(impact_file, IMPACT_MAGIC, 'an impact ordered postings file')
+
+    def segments(self, term_id):
+        """
+        Returns the segments of a term as [(level, count, doc section, float32 weights), ...], highest
+        level first, the doc sections and weights being slices of the mapping
+        """
+        buf = self.view
+        num_segments, pos = decode_varint(buf, self.offsets[term_id])
+        segments = []
+        for _ in range(num_segments):
+            level, pos = decode_varint(buf, pos)
+            count, pos = decode_varint(buf, pos)
+            doc_len, pos = decode_varint(buf, pos)
+            weight_pos = pos + doc_len
+            segments.append((level, count, buf[pos:weight_pos], buf[weight_pos:weight_pos + 4 * count]))
+            pos = weight_pos + 4 * count
+        return segments
+
+
+def encode_positions(doc_ids, doc_positions):
+    """
+    Encode the positions of a term into a positions record (see module docstring)
+    doc_positions: the sorted positions of the term in each doc of the sorted doc_ids
+    """
+    n = len(doc_ids)
+    k = skip_distance(n)
+    docs = bytearray()
+    skips = []
+    prev = 0
+    for i, (doc_id, positions) in enumerate(zip(doc_ids, doc_positions)):
+        if k and i and i % k == 0:
+            skips.append((prev, len(docs)))
+        encode_varint(doc_id - prev, docs)
+        prev = doc_id
+        gaps = bytearray()
+        prev_position = 0
+        for position in positions:
+            encode_varint(position - prev_position, gaps)
+            prev_position = position
+        encode_varint(len(gaps), docs)
+        docs += gaps
+    record = bytearray()
+    encode_varint(n, record)
+    encode_varint(len(skips), record)
+    for doc_id, pos in skips:
+        encode_varint(doc_id, record)
+        encode_varint(pos, record)
+    return bytes(record + docs)
+
+
+class PositionsWriter(TermRecordWriter):
+    """
+    Writes postings.txt.pos, one record per term added in increasing term_id from 0
+    """
+
+    def __init__(self, positions_file):
+        super().__init__(positions_file, POSITIONS_MAGIC)
+
+    def add(self, doc_ids, doc_positions):
+        self.add_record(encode_positions(doc_ids, doc_positions))
+
+
+class PositionsReader(TermRecordReader):
+    """
+    Read only, memory mapped view of postings.txt.pos
+    """
+
+    def __init__(self, positions_file):
+        super().__init__(positions_file, POSITIONS_MAGIC, 'a positions file')
+
+    def positions(self, term_id, doc_ids):
+        """
+        Returns {doc_id: [position, ...]} for the docs of the sorted doc_ids containing the term,
+        jumping over the blocks of the record that hold none of them
+        """
+        buf = self.view
+        n, pos = decode_varint(buf, self.offsets[term_id])
+        num_skips, pos = decode_varint(buf, pos)
+        skip_docs = []
+        skip_pos = []
+        for _ in range(num_skips):
+            doc_id, pos = decode_varint(buf, pos)
+            offset, pos = decode_varint(buf, pos)
+            skip_docs.append(doc_id)
+            skip_pos.append(offset)
+        section = pos
+        k = skip_distance(n)
+
+        found = {}
+        i = 0  # index of the next posting, which starts at pos and follows prev
+        prev = 0
+        t = 0  # index of the next doc of doc_ids to look for
+        while t < len(doc_ids) and i < n:
+            # jump to the last block starting after a doc_id lower than the next doc, if it is ahead
+            j = bisect.bisect_left(skip_docs, doc_ids[t]) - 1
+            if j >= 0 and (j + 1) * k > i:
+                i = (j + 1) * k
+                pos = section + skip_pos[j]
+                prev = skip_docs[j]
+            gap, pos = decode_varint(buf, pos)
+            doc_id = prev + gap
+            positions_len, pos = decode_varint(buf, pos)
+            end = pos + positions_len
+            t = bisect.bisect_left(doc_ids, doc_id, t)
+            if t < len(doc_ids) and doc_ids[t] == doc_id:
+                positions = []
+                position = 0
+                while pos < end:
+                    gap, pos = decode_varint(buf, pos)
+                    position += gap
+                    positions.append(position)
+                found[doc_id] = positions
+                t += 1
+            i += 1
+            pos = end
+            prev = doc_id
+        return found
+
+
+def write_doc_map(doc_map_file, external_ids):
+    """
+    external_ids: the external doc_id of internal doc_ids 1..N, in order
+    """
+    doc_map = array.array('I', [0])
+    doc_map.extend(external_ids)
+    if sys.byteorder == 'big':
+        doc_map.byteswap()
+    with open(doc_map_file, 'wb') as f:
+        f.write(DOC_MAP_MAGIC + struct.pack('<B3x', VERSION))
+        f.write(doc_map.tobytes())
+
+
+def read_doc_map(doc_map_file):
+    """
+    Returns the array of the external doc_id of every internal doc_id
+    """
+    with open(doc_map_file, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+        if header[:4] != DOC_MAP_MAGIC or header[4] != VERSION:
+            raise ValueError(f'{doc_map_file} is not a doc_id map')
+        doc_map = array.array('I', f.read())
+    if sys.byteorder == 'big':
+        doc_map.byteswap()
+    return doc_map
@@ -0,0 +1,178 @@
+"""
+Opt-in instrumentation of index.py and search.py: stage timers, counters and per query traces
+
+Disabled by default, in which case timer() returns a shared no-op context manager, count() returns
+right away and timed functions are called straight through, so the instrumented code paths only pay
+a call and a branch, once per document, block, posting list or query but never per posting.
+enable() turns it on:
+
+    with profiling.timer('fetch'):      exclusive time of a stage (time in nested stages is not counted)
+    @profiling.timed('write')           the same around every call of a function
+    profiling.count('postings', n)      add n to a counter
+
+Between begin_query and end_query, timings and counters go to a profile of that query (per thread),
+which end_query adds to the totals and writes as one JSON line to the trace file if one was given.
+summary() returns the totals.
+"""
+import functools
+import json
+import threading
+import time
+
+enabled = False
+local = threading.local()  # profile of the query being run by this thread
+lock = threading.Lock()
+trace_file = None
+
+
+class Profile:
+    """
+    Exclusive seconds and calls of each stage, and counters
+    """
+
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.counters = {}
+        self.stack = []  # [stage, start, seconds spent in nested stages]
+
+    def start(self, stage):
+        self.stack.append([stage, time.perf_counter(), 0.0])
+
+    def stop(self):
+        stage, start, nested = self.stack.pop()
+        elapsed = time.perf_counter() - start
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + elapsed - nested
+        self.calls[stage] = self.calls.get(stage, 0) + 1
+        if self.stack:
+            self.stack[-1][2] += elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add(self, other):
+        for stage, seconds in other.seconds.items():
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + other.calls[stage]
+        for name, n in other.counters.items():
+            self.count(name, n)
+
+    def report(self):
+        return {'stages': {stage: {'seconds': round(seconds, 6), 'calls': self.calls[stage]}
+                           for stage, seconds in self.seconds.items()},
+                'counters': dict(self.counters)}
+
+
+totals = Profile()
+
+
+class StageTimer:
+    def __init__(self, profile, stage):
+        self.profile = profile
+        self.stage = stage
+
+    def __enter__(self):
+        self.profile.start(self.stage)
+
+    def __exit__(self, *exc):
+        self.profile.stop()
+
+
+class NullTimer:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+def current_profile():
+    return getattr(local, 'profile', None) or totals
+
+
+def enable(trace_path=None):
+    """
+    Start collecting timings and counters, writing a JSON line per query to trace_path if given
+    """
+    global enabled, trace_file
+    enabled = True
+    if trace_path:
+        trace_file = open(trace_path, 'w')
+
+
+def disable():
+    global enabled, trace_file
+    enabled = False
+    if trace_file:
+        trace_file.close()
+        trace_file = None
+
+
+def timer(stage):
+    if not enabled:
+        return NULL_TIMER
+    return StageTimer(current_profile(), stage)
+
+
+def timed(stage):
+    """
+    Decorator timing every call of the function as stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with StageTimer(current_profile(), stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    if enabled:
+        current_profile().count(name, n)
+
+
+def begin_query():
+    if enabled:
+        local.profile = Profile()
+        local.start = time.perf_counter()
+
+
+def end_query(query, tokenized_query, result):
+    """
+    Add the profile of the query to the totals and write its trace record
+    """
+    if not enabled:
+        return
+    profile = local.profile
+    local.profile = None
+    seconds = time.perf_counter() - local.start
+    with lock:
+        totals.add(profile)
+        totals.count('queries')
+        if trace_file:
+            record = {'query': query, 'terms': tokenized_query, 'results': len(result),
+                      'ms': round(1000 * seconds, 4),
+                      'stages': {stage: round(1000 * s, 4) for stage, s in profile.seconds.items()},
+                      'counters': profile.counters}
+            trace_file.write(json.dumps(record) + '\n')
+
+
+def summary():
+    with lock:
+        return totals.report()
+
+
+def write_summary(path, extra=None):
+    """
+    Write summary() as JSON to path, with the entries of extra added
+    """
+    report = summary()
+    report.update(extra or {})
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
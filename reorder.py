@@ -0,0 +1,105 @@
+"""
+Document reordering by recursive graph bisection, used by index.py --reorder
+
+Documents sharing terms should get nearby doc_ids, so the gaps of the posting lists are small (fewer
+varint bytes) and the docs of a posting list are close in the score accumulator. The documents are
+split in two halves, and docs are swapped between the halves while the swaps lower the estimated cost
+of gap encoding every posting list, sum over terms of deg * log2(n / (deg + 1)) in each half (deg: docs
+of the half containing the term, n: docs of the half). The halves are then bisected in turn down to
+LEAF_SIZE docs. See Dhulipala et al., Compressing graphs and indexes with recursive graph bisection.
+
+The gains of the docs are computed with numpy over the whole doc -> terms graph, one pass per iteration
+of each level, so reordering costs a few passes over the postings per level.
+"""
+import math
+
+try:
+    import numpy as np
+except ImportError:  # only needed by index.py --reorder
+    np = None
+
+LEAF_SIZE = 16  # partitions of at most this many docs keep their order
+ITERATIONS = 8  # most rounds of swaps per bisection
+
+
+class DocGraph:
+    """
+    Terms of every document in compressed sparse rows: the terms of doc i are
+    terms[offsets[i]:offsets[i + 1]], numbered 0..num_terms - 1
+    """
+
+    def __init__(self, doc_indexes, term_indexes, num_docs, num_terms):
+        """
+        doc_indexes, term_indexes: arrays of the (doc, term) edges, in any order
+        """
+        doc_indexes = np.asarray(doc_indexes, dtype=np.int64)
+        order = np.argsort(doc_indexes, kind='stable')
+        self.terms = np.asarray(term_indexes, dtype=np.int64)[order]
+        self.offsets = np.zeros(num_docs + 1, dtype=np.int64)
+        np.cumsum(np.bincount(doc_indexes, minlength=num_docs), out=self.offsets[1:])
+        self.num_terms = num_terms
+
+    def edges(self, docs):
+        """
+        Returns (position in docs, term) of every edge of the docs
+        """
+        starts = self.offsets[docs]
+        lengths = self.offsets[docs + 1] - starts
+        positions = np.repeat(np.arange(len(docs)), lengths)
+        first_edge = np.cumsum(lengths) - lengths
+        edges = np.repeat(starts - first_edge, lengths) + np.arange(lengths.sum())
+        return positions, self.terms[edges]
+
+
+def gap_cost(degrees, n):
+    return degrees * np.log2(n / (degrees + 1.0))
+
+
+def move_gains(degrees, other_degrees, n, other_n, positions, terms, num_docs):
+    """
+    Returns the decrease of the cost of each doc leaving its half (degrees) for the other one
+    """
+    before = gap_cost(degrees, n) + gap_cost(other_degrees, other_n)
+    after = gap_cost(np.maximum(degrees - 1, 0), n) + gap_cost(other_degrees + 1, other_n)
+    return np.bincount(positions, weights=(before - after)[terms], minlength=num_docs)
+
+
+def bisect(graph, docs, iterations=ITERATIONS):
+    """
+    Returns docs reordered by recursive bisection
+    """
+    if len(docs) <= LEAF_SIZE:
+        return docs
+    half = len(docs) // 2
+    left, right = docs[:half].copy(), docs[half:].copy()
+    for _ in range(iterations):
+        left_positions, left_terms = graph.edges(left)
+        right_positions, right_terms = graph.edges(right)
+        left_degrees = np.bincount(left_terms, minlength=graph.num_terms)
+        right_degrees = np.bincount(right_terms, minlength=graph.num_terms)
+        left_gains = move_gains(left_degrees, right_degrees, len(left), len(right), left_positions, left_terms,
+                                len(left))
+        right_gains = move_gains(right_degrees, left_degrees, len(right), len(left), right_positions,
+                                 right_terms, len(right))
+        left_order = np.argsort(-left_gains, kind='stable')
+        right_order = np.argsort(-right_gains, kind='stable')
+        pairs = min(len(left_order), len(right_order))
+        swaps = int(np.count_nonzero(left_gains[left_order[:pairs]] + right_gains[right_order[:pairs]] > 0))
+        if not swaps:
+            break
+        moved_left = left[left_order[:swaps]].copy()
+        left[left_order[:swaps]] = right[right_order[:swaps]]
+        right[right_order[:swaps]] = moved_left
+    # docs keep their original relative order inside a half, which is also the order of the leaves
+    left.sort()
+    right.sort()
+    return np.concatenate([bisect(graph, left, iterations), bisect(graph, right, iterations)])
+
+
+def bisection_order(graph, num_docs, iterations=ITERATIONS):
+    """
+    Returns the doc indexes 0..num_docs - 1 in their new order
+    """
+    depth = max(0, math.ceil(math.log2(max(1, num_docs) / LEAF_SIZE)))
+    print(f'reordering {num_docs} docs, {depth} levels of bisection')
+    return bisect(graph, np.arange(num_docs), iterations)
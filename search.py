@@ -1,65 +1,643 @@
 #!/usr/bin/python3
 import re
-import nltk
+import os
 import sys
 import getopt
 import json
 import heapq
-from nltk.tokenize import *
+import bisect
+import asyncio
+import threading
+import concurrent.futures
+import urllib.parse
+import itertools
+import multiprocessing
 from math import log10
+import postings_format
+import lexicon
+import analyzer
+import segments
+import profiling
+from cache import LRUCache
 
-stemmer = nltk.stem.PorterStemmer()
+try:
+    import numpy as np
+except ImportError:  # only needed by the numpy scorer
+    np = None
+
+SCORERS = ('dict', 'numpy', 'maxscore', 'impact')
+ACCUMULATOR_SCORERS = ('numpy', 'impact')  # scorers adding into the dense array of new_accumulator
+QUERY_BATCH_PER_WORKER = 64  # queries handed to the pool per worker at a time
+END_OF_POSTINGS = float('inf')  # doc_id of a cursor past the end of its posting list
+ALL_TERMS = -1  # min_match value requiring every distinct query term
+PRUNING_EPSILON = 1e-9  # slack for float rounding when comparing score upper bounds to the threshold
+RESULT_CACHE_BYTES = 16 * 1024 * 1024  # default size of the query -> top k results cache
+POSTINGS_CACHE_BYTES = 128 * 1024 * 1024  # default size of the term -> decoded postings cache
+IMPACT_BUDGET = 1.0  # fraction of a query's postings the impact scorer adds before stopping
+PHRASE = re.compile(r'"([^"]*)"(?:~(\d+))?')  # "phrase" or "proximity"~slop operator of a query
+PHRASE_CANDIDATES = 4  # candidates of a phrase query checked first, as a multiple of k, then twice as many
+BATCH_BYTES = 256 * 1024 * 1024  # most bytes of the dense score arrays of batch_top_docs, split into passes above
+POSTING_BYTES = sys.getsizeof([0, 0.0]) + sys.getsizeof(0.0) + sys.getsizeof(2 ** 20)  # one decoded [doc_id, weight]
 
 
 def usage():
-    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results")
+    print("usage: " + sys.argv[0] + " -d dictionary-file -p postings-file -q file-of-queries -o output-file-of-results"
+          " [-k depth] [--with-scores] [--scorer dict|numpy|maxscore|impact] [--impact-budget F]"
+          " [--conjunctive | --min-match N] [--workers N] [--start N] [--result-cache BYTES] [--postings-cache BYTES]"
+          " [--batch N (numpy scorer, every query term optional)] [--trace FILE] [--profile FILE]")
+    print("       " + sys.argv[0] + " -d dictionary-file -p postings-file (--serve host:port | --socket path)"
+          " [-k depth] [--scorer dict|numpy|maxscore|impact] [--impact-budget F] [--conjunctive | --min-match N]"
+          " [--result-cache BYTES] [--postings-cache BYTES]")
 
 
-def run_search(dict_file, postings_file, queries_file, results_file):
+def run_search(dict_file, postings_file, queries_file, results_file, scorer='dict', min_match=0, k=10,
+               with_scores=False, workers=1, start=0, cache_sizes=(RESULT_CACHE_BYTES, POSTINGS_CACHE_BYTES),
+               budget=IMPACT_BUDGET, batch=0):
     """
     using the given dictionary file and postings file,
     perform searching on the given queries file and output the results to a file
+
+    scorer: 'dict' accumulates scores in a python dict, 'numpy' in a dense array indexed by doc_id,
+            'maxscore' evaluates document at a time and skips docs that cannot make the top k,
+            'impact' evaluates score at a time over the impact ordered postings of index.py --impact
+            (the dict scorer is used without them)
+    min_match: only rank docs containing at least min_match distinct query terms (ALL_TERMS for all),
+               0 ranks every doc containing any query term with the chosen scorer
+    k: number of docs returned per query
+    with_scores: write 'doc_id,score' instead of doc_id for every result
+    workers: number of processes ranking the queries, a sharded index uses one process per shard instead
+    start: resume an interrupted run, skipping the first start queries and keeping their results
+           already in results_file
+    cache_sizes: bytes of the (result, postings) caches of SearchCache, 0 disables a level
+    budget: fraction of each query's postings scored by the impact scorer, 1 scores them all
+    batch: rank this many queries at a time with rank_batch, sharing the postings of their terms,
+           instead of one by one with the chosen scorer (not with workers or a sharded index)
     """
     print('running search on the queries...')
+    options = (scorer, min_match, k, with_scores, budget)
+    if segments.is_sharded(dict_file):
+        run_search_sharded(dict_file, queries_file, results_file, options, start, cache_sizes)
+        return
+    if workers > 1 and not batch:
+        run_search_parallel(dict_file, postings_file, queries_file, results_file, options, workers, start,
+                            cache_sizes)
+        return
 
-    with open(dict_file, 'r') as f:
-        global_dict = json.load(f)  # Dictionary in the form 'term: [termid, doc_freq, byte_offset]'
-    postings_fd = open(postings_file, 'r')  # open in read mode
-    queries_fd = open(queries_file, 'r')  # open in read mode
-    queries_list = queries_fd.read().splitlines()
-    result_list = []
-    for query in queries_list:
-        tokenized_query = parse_query(query, global_dict)                   # tokenize and process query
-        score = compute_score(tokenized_query, global_dict, postings_fd)    # add scores
-        if not score:   # no valid docIDs found, so just append an empty list of docIDs to result
-            result_list.append([])
-            continue
-        top_10_docs = get_top_docs(score)
-        result_list.append(top_10_docs)
-
-    # write results to output file
-    i = 0
-    result_len_minus_one = len(result_list) - 1
-    with open(results_file, 'w') as r_file:
-        for result in result_list:
-            result_str = ''
-            if result:  # there are valid docIDs found in result
-                for posting in result:
-                    result_str += str(posting) + ' '
-            if i == result_len_minus_one:
-                r_file.write(result_str.strip())    # do not add newline for last result
-                continue
-            r_file.write(result_str.strip() + "\n")
-            i += 1
-    r_file.close()
+    # Dictionary in the form 'term: [termid, idf, byte_offset, length, doc_freq, max_weight]', json or binary lexicon
+    global_dict, postings = load_index(dict_file, postings_file)
+    accumulator = new_accumulator(global_dict, postings) if scorer in ACCUMULATOR_SCORERS or batch else None
+    cache = SearchCache(dict_file, postings_file, *cache_sizes)
+
+    def results(queries):
+        if batch:
+            while True:
+                tokenized_queries = [parse_query(query, global_dict) for query in itertools.islice(queries, batch)]
+                if not tokenized_queries:
+                    return
+                profiling.count('queries', len(tokenized_queries))
+                yield from rank_batch(tokenized_queries, global_dict, postings, k, with_scores, accumulator, cache)
+        for query in queries:
+            profiling.begin_query()
+            tokenized_query = parse_query(query, global_dict)               # tokenize and process query
+            result = rank_query(tokenized_query, global_dict, postings, scorer, min_match, k, with_scores,
+                                accumulator, cache, budget)
+            profiling.end_query(query, tokenized_query, result)
+            yield result
+
+    # queries are read, ranked and written to the output file one at a time
+    with open(queries_file, 'r') as queries_fd:
+        write_results(results(read_queries(queries_fd, start)), results_file, start)
+    postings.close()
+    print('cache: ' + json.dumps(cache.stats()))
 
     return
 
 
+def close_index(global_dict, postings):
+    """
+    Close the postings returned by load_index, and the dictionary if it is a binary lexicon
+    """
+    postings.close()
+    if isinstance(global_dict, lexicon.Lexicon):
+        global_dict.close()
+
+
+@profiling.timed('load')
+def load_index(dict_file, postings_file):
+    """
+    Returns (global_dict, postings): the json or binary dictionary and the memory mapped PostingsReader.
+    If dict_file is the manifest of a segmented index, both are the SegmentedIndex of its segments.
+    The secondary tier written by index.py next to the dictionary and postings is loaded as postings.tier.
+    The stem cache saved by index.py --stem-cache next to the dictionary is loaded if present.
+    """
+    if segments.is_manifest(dict_file):
+        global_dict = postings = segments.SegmentedIndex(dict_file)
+    else:
+        global_dict = lexicon.load_dictionary(dict_file)
+        postings = postings_format.PostingsReader(postings_file)
+        if os.path.exists(dict_file + segments.TIER_SUFFIX):
+            postings.tier = segments.TieredIndex(global_dict, postings,
+                                                 lexicon.load_dictionary(dict_file + segments.TIER_SUFFIX),
+                                                 postings_format.PostingsReader(postings_file + segments.TIER_SUFFIX))
+    stem_cache_file = dict_file + analyzer.STEM_CACHE_SUFFIX
+    if os.path.exists(stem_cache_file):
+        analyzer.load_stem_cache(stem_cache_file)
+    return global_dict, postings
+
+
+def index_stamp(dict_file, postings_file):
+    """
+    (mtime, size) of the index files, which changes whenever index.py rewrites them
+    A segmented index has no postings file, its manifest is rewritten on every change
+    """
+    return tuple((st.st_mtime_ns, st.st_size) for st in (os.stat(f) for f in (dict_file, postings_file)
+                                                          if os.path.exists(f)))
+
+
+def result_size(result):
+    return sys.getsizeof(result) + sum(sys.getsizeof(r) for r in result)
+
+
+def postings_size(posting_list):
+    """
+    Approximate bytes held by a decoded posting list, a list of [doc_id, weight] or a pair of numpy arrays
+    """
+    if isinstance(posting_list, tuple):
+        return sum(a.nbytes for a in posting_list) + sys.getsizeof(posting_list)
+    return sys.getsizeof(posting_list) + len(posting_list) * POSTING_BYTES
+
+
+class SearchCache:
+    """
+    Two level cache of one loaded index:
+        results     (parsed query terms, scorer, min_match, k, with_scores) -> top k results
+        postings    (term, 'list' or 'arrays') -> decoded posting list
+    Both are LRU caches bounded in bytes. Queries are keyed after analysis, so queries that only differ
+    in case, punctuation or unknown words share an entry. Posting lists are cached for the dict and numpy
+    scorers, maxscore and conjunctive search read their cursors straight from the memory map, and the
+    impact scorer its segments.
+
+    stamp records the index files the entries were computed from, taken before loading them (by default
+    now): is_stale tells when index.py has rewritten them. The server then loads the index again with a
+    new SearchCache, so searches still running on the old index never fill the new cache.
+    """
+
+    def __init__(self, dict_file, postings_file, result_bytes=RESULT_CACHE_BYTES,
+                 postings_bytes=POSTINGS_CACHE_BYTES, stamp=None):
+        self.files = (dict_file, postings_file)
+        self.stamp = stamp if stamp is not None else index_stamp(*self.files)
+        self.results = LRUCache(max_bytes=result_bytes, sizeof=result_size)
+        self.postings = LRUCache(max_bytes=postings_bytes, sizeof=postings_size)
+
+    def is_stale(self):
+        return index_stamp(*self.files) != self.stamp
+
+    def stats(self):
+        return {'results': self.results.stats(), 'postings': self.postings.stats()}
+
+
+def read_queries(queries_fd, start=0):
+    """
+    Lazily yield the queries of a file, one per line, from the start-th query on
+    """
+    return (line.rstrip('\n') for line in itertools.islice(queries_fd, start, None))
+
+
+def write_results(results, results_file, start=0):
+    """
+    Write each result on its own line as soon as it is produced, without a newline after the last one
+
+    With start > 0 the first start results already in results_file are kept (anything written
+    after them by an interrupted run is dropped) and the new results are appended.
+    """
+    mode = 'w'
+    if start:
+        truncate_results(results_file, start)
+        mode = 'a'
+    with open(results_file, mode) as r_file:
+        for i, result in enumerate(results):
+            if i or start:
+                r_file.write("\n")
+            r_file.write(format_result(result))
+            r_file.flush()
+
+
+def truncate_results(results_file, num_results):
+    """
+    Truncate results_file right after its first num_results results
+    """
+    with open(results_file, 'rb+') as r_file:
+        position = 0
+        for _ in range(num_results):
+            line = r_file.readline()
+            if not line:
+                raise ValueError(f'{results_file} holds fewer than {num_results} results')
+            position += len(line)
+        if line.endswith(b'\n'):
+            position -= 1
+        r_file.truncate(position)
+
+
+# Index loaded once in each worker process of run_search_parallel:
+# (global_dict, postings, accumulator, cache, options)
+worker_state = None
+
+
+def init_worker(dict_file, postings_file, options, cache_sizes):
+    global worker_state
+    global_dict, postings = load_index(dict_file, postings_file)
+    accumulator = new_accumulator(global_dict, postings) if options[0] in ACCUMULATOR_SCORERS else None
+    cache = SearchCache(dict_file, postings_file, *cache_sizes)
+    worker_state = (global_dict, postings, accumulator, cache, options)
+
+
+def search_in_worker(query):
+    global_dict, postings, accumulator, cache, (scorer, min_match, k, with_scores, budget) = worker_state
+    tokenized_query = parse_query(query, global_dict)
+    return rank_query(tokenized_query, global_dict, postings, scorer, min_match, k, with_scores, accumulator,
+                      cache, budget)
+
+
+def run_search_parallel(dict_file, postings_file, queries_file, results_file, options, workers, start=0,
+                        cache_sizes=(RESULT_CACHE_BYTES, POSTINGS_CACHE_BYTES)):
+    """
+    Rank the queries in a pool of worker processes and write the results in input order as they finish
+
+    Every worker memory maps the same read-only dictionary and postings files, so the index is shared
+    through the page cache. Queries are read lazily and handed to the pool in batches, so neither the
+    queries nor the results are held in memory all at once.
+    options: (scorer, min_match, k, with_scores, budget), see run_search
+    start: number of queries to skip when resuming, see run_search
+    cache_sizes: see run_search, every worker has its own caches
+    """
+    batch_size = workers * QUERY_BATCH_PER_WORKER
+    with multiprocessing.Pool(workers, init_worker, (dict_file, postings_file, options, cache_sizes)) as pool, \
+            open(queries_file, 'r') as queries_fd:
+        queries = read_queries(queries_fd, start)
+
+        def results():
+            while True:
+                batch = list(itertools.islice(queries, batch_size))
+                if not batch:
+                    return
+                yield from pool.imap(search_in_worker, batch, chunksize=max(1, len(batch) // (4 * workers)))
+
+        write_results(results(), results_file, start)
+
+
+# Shard loaded once in each shard process of run_search_sharded: (view, accumulator, cache, options)
+shard_state = None
+
+
+def init_shard(dict_file, segment, options, cache_sizes):
+    global shard_state
+    view = segments.ShardView(dict_file, [segment])
+    accumulator = new_accumulator(view, view) if options[0] in ACCUMULATOR_SCORERS else None
+    cache = SearchCache(dict_file, segments.segment_path(dict_file, segment['postings']), *cache_sizes)
+    shard_state = (view, accumulator, cache, options)
+
+
+def search_shard(tokenized_queries, global_stats):
+    """
+    Returns the top k (doc_id, score) of this shard for each parsed query, scored with global_stats
+    """
+    view, accumulator, cache, (scorer, min_match, k, _, budget) = shard_state
+    view.use_global_stats(global_stats)
+    return [rank_query(tokenized_query, view, view, scorer, min_match, k, True, accumulator, cache, budget)
+            for tokenized_query in tokenized_queries]
+
+
+def merge_top_docs(shard_results, k=10, with_scores=False):
+    """
+    Merge the top k (doc_id, score) of every shard into the global top k, ordered like get_top_docs
+    """
+    top = heapq.nsmallest(k, ((-score, doc_id) for result in shard_results for doc_id, score in result))
+    if with_scores:
+        return [(doc_id, -neg_score) for neg_score, doc_id in top]
+    return [doc_id for _, doc_id in top]
+
+
+def run_search_sharded(dict_file, queries_file, results_file, options, start=0,
+                       cache_sizes=(RESULT_CACHE_BYTES, POSTINGS_CACHE_BYTES)):
+    """
+    Scatter-gather search over the shards of an index built with index.py --shards
+
+    Every shard is held by its own process. The queries are parsed here, and the N and doc_freq of
+    their terms are looked up over all shards, so each shard scores with the idf of the whole
+    collection and the per shard top k can be merged by score.
+    options: (scorer, min_match, k, with_scores, budget), see run_search
+    """
+    scorer, min_match, k, with_scores, _ = options
+    global_index = segments.SegmentedIndex(dict_file)    # statistics of the whole collection
+    pools = [multiprocessing.Pool(1, init_shard, (dict_file, segment, options, cache_sizes))
+             for segment in segments.read_manifest(dict_file)['_segments']]
+    try:
+        with open(queries_file, 'r') as queries_fd:
+            queries = read_queries(queries_fd, start)
+
+            def results():
+                while True:
+                    batch = [parse_query(query, global_index)
+                             for query in itertools.islice(queries, QUERY_BATCH_PER_WORKER)]
+                    if not batch:
+                        return
+                    global_stats = {term: global_index.term_stats(term) for terms in batch for term in terms}
+                    replies = [pool.apply_async(search_shard, (batch, global_stats)) for pool in pools]
+                    shard_results = [reply.get() for reply in replies]
+                    for i in range(len(batch)):
+                        yield merge_top_docs([result[i] for result in shard_results], k, with_scores)
+
+            write_results(results(), results_file, start)
+    finally:
+        for pool in pools:
+            pool.close()
+            pool.join()
+        global_index.close()
+
+
+def serve(dict_file, postings_file, address=None, socket_path=None, scorer='dict', min_match=0, k=10,
+          cache_sizes=(RESULT_CACHE_BYTES, POSTINGS_CACHE_BYTES), budget=IMPACT_BUDGET):
+    """
+    Load the dictionary and postings once and answer queries over HTTP until interrupted
+
+    Listens on address (host, port) or on the unix socket socket_path and answers
+        GET /search?q=query[&k=depth]      or      POST /search with {"query": ..., "k": ...}
+    with {"query": ..., "results": [{"doc_id": ..., "score": ...}, ...]}, and GET /stats with the cache counters.
+    Connections are handled by asyncio and queries are ranked in a thread pool, which is safe as the
+    memory mapped index is read only. When index.py rewrites the index files, they are loaded again
+    with empty caches before the next query. See run_search for the other options.
+    """
+
+    def load():
+        # the stamp is taken before loading, and the index loaded again if index.py replaced one of
+        # its files meanwhile, so the cache never claims files newer than those loaded
+        while True:
+            stamp = index_stamp(dict_file, postings_file)
+            global_dict, postings = load_index(dict_file, postings_file)
+            if index_stamp(dict_file, postings_file) == stamp:
+                return [global_dict, postings, SearchCache(dict_file, postings_file, *cache_sizes, stamp), 0]
+            close_index(global_dict, postings)
+
+    index = load()  # [global_dict, postings, cache, searches running on it], replaced as a whole on reload
+    reload_lock = threading.Lock()
+    executor = concurrent.futures.ThreadPoolExecutor()
+    thread_state = threading.local()   # the numpy accumulator is per thread
+
+    def reload_due():
+        # index.py replaces the dictionary last: until then the loaded index keeps the files it mapped
+        return index[2].is_stale() and not os.path.exists(dict_file + postings_format.TMP_SUFFIX)
+
+    def acquire():
+        nonlocal index
+        stale = reload_due()   # outside the lock, checked again under it
+        with reload_lock:
+            if stale and reload_due():
+                previous, index = index, load()
+                if not previous[3]:
+                    close_index(*previous[:2])
+            index[3] += 1
+            return index
+
+    def release(loaded):
+        with reload_lock:
+            loaded[3] -= 1
+            if loaded is not index and not loaded[3]:   # replaced, and its last search is done
+                close_index(*loaded[:2])
+
+    def search(query, depth):
+        loaded = acquire()
+        try:
+            return search_loaded(query, depth, *loaded[:3])
+        finally:
+            release(loaded)
+
+    def search_loaded(query, depth, global_dict, postings, cache):
+        accumulator = None
+        if scorer in ACCUMULATOR_SCORERS:
+            if getattr(thread_state, 'stamp', None) != cache.stamp:
+                thread_state.accumulator = new_accumulator(global_dict, postings)
+                thread_state.stamp = cache.stamp
+            accumulator = thread_state.accumulator
+        profiling.begin_query()
+        tokenized_query = parse_query(query, global_dict)
+        result = rank_query(tokenized_query, global_dict, postings, scorer, min_match, depth, True, accumulator,
+                            cache, budget)
+        profiling.end_query(query, tokenized_query, result)
+        return {'query': query, 'results': [{'doc_id': doc_id, 'score': score} for doc_id, score in result]}
+
+    async def handle(reader, writer):
+        try:
+            status, body = await handle_request(reader)
+        except Exception as e:  # malformed request, keep serving
+            status, body = '400 Bad Request', {'error': str(e)}
+        data = json.dumps(body).encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode() + data)
+        await writer.drain()
+        writer.close()
+
+    async def handle_request(reader):
+        method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+        content_length = 0
+        while True:
+            header = (await reader.readline()).decode('latin-1').strip()
+            if not header:
+                break
+            name, _, value = header.partition(':')
+            if name.strip().lower() == 'content-length':
+                content_length = int(value)
+
+        url = urllib.parse.urlsplit(target)
+        if url.path == '/stats':
+            stats = index[2].stats()
+            if profiling.enabled:
+                stats['profile'] = profiling.summary()
+            return '200 OK', stats
+        if url.path != '/search':
+            return '404 Not Found', {'error': f'unknown path {url.path}'}
+        if method == 'GET':
+            params = urllib.parse.parse_qs(url.query)
+            query = params.get('q', [''])[0]
+            depth = int(params.get('k', [k])[0])
+        elif method == 'POST':
+            params = json.loads(await reader.readexactly(content_length)) if content_length else {}
+            query = params.get('query', '')
+            depth = int(params.get('k', k))
+        else:
+            return '405 Method Not Allowed', {'error': f'unsupported method {method}'}
+        if depth < 1:
+            return '400 Bad Request', {'error': 'k must be at least 1'}
+        loop = asyncio.get_running_loop()
+        return '200 OK', await loop.run_in_executor(executor, search, query, depth)
+
+    async def main():
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(handle, path=socket_path)
+        else:
+            server = await asyncio.start_server(handle, address[0], address[1])
+        print(f'serving on {socket_path or "%s:%d" % address}')
+        async with server:
+            await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown()
+        close_index(*index[:2])
+
+
+def rank_query(tokenized_query, global_dict, postings, scorer='dict', min_match=0, k=10, with_scores=False,
+               accumulator=None, cache=None, budget=IMPACT_BUDGET):
+    """
+    Returns the top k doc_ids of a parsed query, or (doc_id, score) pairs if with_scores
+    See run_search for the scorer, min_match and budget options, accumulator is needed by the numpy
+    and impact scorers
+    cache: optional SearchCache of this index, the returned list must not be modified
+    """
+    if cache is None:
+        return compute_top_docs(tokenized_query, global_dict, postings, scorer, min_match, k, with_scores,
+                                accumulator, budget=budget)
+    key = (tuple(tokenized_query), getattr(tokenized_query, 'phrases', ()), scorer, min_match, k, with_scores,
+           budget)
+    result = cache.results.get(key)
+    if result is not None:
+        profiling.count('result_cache_hits')
+    else:
+        result = compute_top_docs(tokenized_query, global_dict, postings, scorer, min_match, k, with_scores,
+                                  accumulator, cache, budget)
+        cache.results.put(key, result)
+    return result
+
+
+def rank_batch(tokenized_queries, global_dict, postings, k=10, with_scores=False, accumulator=None, cache=None):
+    """
+    Returns the top k of every parsed query of a batch, as rank_query with the numpy scorer would
+    The queries are scored together by batch_top_docs, except those with phrase operators on an index
+    with positions, which are ranked one by one.
+    """
+    with_positions = getattr(postings, 'positions', None) is not None
+    alone = [with_positions and bool(getattr(tokenized_query, 'phrases', None))
+             for tokenized_query in tokenized_queries]
+    batch = [tokenized_query for tokenized_query, single in zip(tokenized_queries, alone) if not single]
+    batch_results = iter(batch_top_docs(batch, global_dict, postings, accumulator, k, with_scores, cache,
+                                        getattr(postings, 'doc_map', None)))
+    results = []
+    for tokenized_query, single in zip(tokenized_queries, alone):
+        if single:
+            results.append(rank_query(tokenized_query, global_dict, postings, 'numpy', 0, k, with_scores,
+                                      accumulator, cache))
+        else:
+            results.append(complete_top_docs(tokenized_query, postings, next(batch_results), 'numpy', 0, k,
+                                             with_scores, accumulator))
+    return results
+
+
+@profiling.timed('score')
+def compute_top_docs(tokenized_query, global_dict, postings, scorer='dict', min_match=0, k=10, with_scores=False,
+                     accumulator=None, cache=None, budget=IMPACT_BUDGET):
+    """
+    Rank a parsed query with the chosen scorer, see rank_query
+    With a secondary tier, a query is ranked again with the postings of both tiers when the primary
+    one returns fewer than k docs. The doc_ids of a reordered index are mapped back to the external
+    ones, docs of equal scores being ranked in the order of their external doc_ids as in the index
+    without --reorder.
+    The phrase and proximity operators of a query are applied with the positions of index.py --positions
+    (see phrase_top_docs), and ignored without them.
+    """
+    phrase_positions = None
+    phrases = getattr(tokenized_query, 'phrases', None)
+    if phrases and getattr(postings, 'positions', None) is not None:
+        operator_terms = {term for terms, _ in phrases for term in terms}
+        if any(term not in global_dict for term in operator_terms):
+            return []   # no doc holds the terms of the operator
+        phrase_positions = (postings.positions, {term: global_dict[term][0] for term in operator_terms})
+    result = score_top_docs(tokenized_query, global_dict, postings, scorer, min_match, k, with_scores,
+                            accumulator, cache, budget, phrase_positions, getattr(postings, 'doc_map', None))
+    return complete_top_docs(tokenized_query, postings, result, scorer, min_match, k, with_scores, accumulator,
+                             budget, phrase_positions)
+
+
+def complete_top_docs(tokenized_query, postings, result, scorer='dict', min_match=0, k=10, with_scores=False,
+                      accumulator=None, budget=IMPACT_BUDGET, phrase_positions=None):
+    """
+    Returns the final top k of a query from its result over the primary index, see compute_top_docs
+    """
+    tier = getattr(postings, 'tier', None)
+    doc_map = getattr(postings, 'doc_map', None)
+    if tier is not None and tokenized_query and len(result) < k:
+        profiling.count('tier_queries')
+        # not cached, the postings cache holds the lists of the primary tier
+        result = score_top_docs(tokenized_query, tier, tier, scorer, min_match, k, with_scores, accumulator,
+                                None, budget, phrase_positions, doc_map)
+    if doc_map is not None:
+        if with_scores:
+            return [(doc_map[doc_id], score) for doc_id, score in result]
+        return [doc_map[doc_id] for doc_id in result]
+    return result
+
+
+def score_top_docs(tokenized_query, global_dict, postings, scorer='dict', min_match=0, k=10, with_scores=False,
+                   accumulator=None, cache=None, budget=IMPACT_BUDGET, phrase_positions=None, doc_map=None):
+    """
+    Rank a parsed query with the chosen scorer over one index, see rank_query
+    phrase_positions: (PositionsReader, term_ids) to rank a query with operators by phrase_top_docs
+    doc_map: the external doc_ids of a reordered index, equal scores are ranked by them
+    """
+    if phrase_positions is not None:
+        return phrase_top_docs(tokenized_query, global_dict, postings, *phrase_positions, k, with_scores, cache,
+                               doc_map)
+    if min_match:
+        return conjunctive_top_docs(tokenized_query, global_dict, postings, min_match, k, with_scores, doc_map)
+    if scorer == 'impact' and getattr(postings, 'impact', None) is not None:   # not for a segmented index
+        doc_ids, scores = compute_score_impact(tokenized_query, global_dict, postings.impact, accumulator, budget)
+        return get_top_docs_numpy(doc_ids, scores, k, with_scores, doc_map)
+    if scorer == 'numpy':
+        doc_ids, scores = compute_score_numpy(tokenized_query, global_dict, postings, accumulator, cache)
+        return get_top_docs_numpy(doc_ids, scores, k, with_scores, doc_map)
+    if scorer == 'maxscore':
+        return maxscore_top_docs(tokenized_query, global_dict, postings, k, with_scores, doc_map)
+    score = compute_score(tokenized_query, global_dict, postings, cache)       # add scores
+    if not score:   # no valid docIDs found, so just return an empty list of docIDs
+        return []
+    return get_top_docs(score, k, with_scores, doc_map)
+
+
+def format_result(result):
+    """
+    Space separated doc_ids of a result, 'doc_id,score' for results with scores
+    """
+    return ' '.join(str(r) if isinstance(r, int) else f'{r[0]},{r[1]}' for r in result)
+
+
+class Query(list):
+    """
+    The terms of a parsed query, with phrases: the (terms, slop) of its phrase and proximity operators,
+    slop being None for a phrase
+    """
+
+    def __init__(self, terms, phrases=()):
+        super().__init__(terms)
+        self.phrases = phrases
+
+
+@profiling.timed('parse_query')
 def parse_query(query, global_dict):
-    word_tokenized_query = word_tokenize(query)
-    alnum_words = [word for word in word_tokenized_query if word.isalnum()]     # only keep alphanumeric terms
-    stemmed_tokens = [stemmer.stem(word) for word in alnum_words]               # stem words
+    """
+    Returns the Query of the terms of query found in the dictionary
+    "new york" requires the terms next to each other in this order, "new york"~3 within a window of
+    2 + 3 positions in any order. Their terms are ranked like the other terms of the query.
+    """
+    phrases = []
+    for text, slop in PHRASE.findall(query):
+        terms = tuple(token.lower() for token in analyzer.analyze(text))
+        if len(terms) > 1:
+            phrases.append((terms, int(slop) if slop else None))
+    if phrases:
+        query = PHRASE.sub(r' \1 ', query)
+
+    stemmed_tokens = analyzer.analyze(query)    # alphanumeric terms, stemmed the same way as index.py
     stemmed_lower_tokens = [token.lower() for token in stemmed_tokens]          # convert tokens to lowercase
 
     # filter out terms in query that are not in dictionary
@@ -67,17 +645,17 @@ def parse_query(query, global_dict):
     for token in stemmed_lower_tokens:
         if token in global_dict:
             filtered_tokens.append(token)
-    return filtered_tokens
+    return Query(filtered_tokens, tuple(phrases))
 
 
-def compute_score(tokenized_query, global_dict, postings_fd):
+def compute_score(tokenized_query, global_dict, postings, cache=None):
     if not tokenized_query:     # no tokens available
         return []
     score = {}
     query_ltc_scores = compute_ltc_scores(tokenized_query, global_dict)
     for token in tokenized_query:
         # list of postings, with each posting being = [doc_id, tf-lnc]
-        processed_postings_list = convert_term_to_postings(token, global_dict, postings_fd)
+        processed_postings_list = convert_term_to_postings(token, global_dict, postings, cache)
         query_score = query_ltc_scores[token]
         for posting in processed_postings_list:     # add lnc of each posting to score_dict
             doc_id = posting[0]
@@ -86,28 +664,216 @@ def compute_score(tokenized_query, global_dict, postings_fd):
             else:
                 score[doc_id] = posting[1] * query_score
 
+    profiling.count('candidates', len(score))
     return score
 
 
-def convert_term_to_postings(term, global_dict, postings_fd):
+@profiling.timed('fetch')
+def convert_term_to_postings(term, global_dict, postings, cache=None):
     """
     Retrieve the posting_list of the given term and convert it to an array of postings.
+
+    postings is the PostingsReader of the postings file
+    cache: optional SearchCache keeping the decoded lists of hot terms
     """
-    term_id, idf, skip_ptr = global_dict[term]
-    postings_fd.seek(skip_ptr, 0)
-    postings_string = postings_fd.readline()
-    postings_string = postings_string.strip()      # strip any newline
+    if cache is not None:
+        posting_list = cache.postings.get((term, 'list'))
+        if posting_list is None:
+            posting_list = convert_term_to_postings(term, global_dict, postings)
+            cache.postings.put((term, 'list'), posting_list)
+        else:
+            profiling.count('postings_cache_hits')
+        return posting_list
+    count_fetch(global_dict[term])
+    if isinstance(postings, segments.SegmentedIndex):
+        return postings.term_postings(term)
+
+    skip_ptr = global_dict[term][2]
+    if postings.weight_format is not None:
+        return postings.postings(skip_ptr)
+
+    postings_string = bytes(postings.line(skip_ptr))
     postings_split = postings_string.split()       # list of each posting with associated components
 
     # split each posting into [doc_id, tf-lnc]
     split_within_postings = []
     for posting in postings_split:
-        posting_components = posting.split(',')
+        posting_components = posting.split(b',')
         # ignore posting_components[2] as it is just skip_ptr
         split_within_postings.append([int(posting_components[0]), float(posting_components[1])])
     return split_within_postings
 
 
+def count_fetch(entry):
+    """
+    Count the postings and bytes of the dictionary entry about to be decoded
+    """
+    if profiling.enabled:
+        profiling.count('postings_decoded', entry[4])
+        profiling.count('bytes_read', entry[3] or 0)   # no length for a segmented index
+
+
+def new_accumulator(global_dict, postings):
+    """
+    Returns a zeroed score array with one slot per doc_id, sized from the universal posting list
+    """
+    doc_ids = get_universal_doc_ids(global_dict, postings)
+    return np.zeros(max(doc_ids) + 1 if doc_ids else 0, dtype=np.float64)
+
+
+def get_universal_doc_ids(global_dict, postings):
+    """
+    Returns the list of all doc_ids in the collection
+    """
+    if isinstance(postings, segments.SegmentedIndex):
+        return postings.doc_ids
+    return segments.universal_doc_ids(global_dict, postings)
+
+
+def compute_score_numpy(tokenized_query, global_dict, postings, accumulator, cache=None):
+    """
+    Term at a time scoring into the dense accumulator, which is left zeroed again on return.
+    Scores are added in the same order as compute_score so both give identical floats.
+
+    Returns (doc_ids, scores) numpy arrays of every doc with a posting of a query term
+    """
+    if not tokenized_query:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    query_ltc_scores = compute_ltc_scores(tokenized_query, global_dict)
+    touched = []
+    for token in tokenized_query:
+        doc_ids, weights = convert_term_to_arrays(token, global_dict, postings, cache)
+        accumulator[doc_ids] += weights * query_ltc_scores[token]
+        touched.append(doc_ids)
+
+    doc_ids = np.unique(np.concatenate(touched))
+    profiling.count('candidates', len(doc_ids))
+    scores = accumulator[doc_ids]
+    accumulator[doc_ids] = 0
+    return doc_ids, scores
+
+
+@profiling.timed('score')
+def batch_top_docs(tokenized_queries, global_dict, postings, accumulator, k=10, with_scores=False, cache=None,
+                   doc_map=None):
+    """
+    Top k docs of every parsed query of a batch over one index, like the numpy scorer
+
+    The posting list of each distinct term of the batch is decoded once, then added for all the
+    queries using it at once: the scores are the product of the sparse query x term matrix of ltc
+    weights and the term x doc matrix of lnc weights, accumulated in a dense query x doc_id array with
+    one row per query (accumulator gives the number of doc_id slots), with a matching array marking the
+    docs touched by each query. The rows are filled in passes of at most BATCH_BYTES of arrays, the
+    postings staying decoded across passes. The n-th terms of the queries are added in the n-th round,
+    so every query adds its terms in its own order and gets the same floats as compute_score_numpy.
+    doc_map: see get_top_docs
+    """
+    arrays = {}
+    for tokenized_query in tokenized_queries:
+        for term in tokenized_query:
+            if term not in arrays:
+                arrays[term] = convert_term_to_arrays(term, global_dict, postings, cache)
+    profiling.count('batch_terms', len(arrays))
+    query_weights = [compute_ltc_scores(tokenized_query, global_dict) for tokenized_query in tokenized_queries]
+
+    # a float64 score and a bool touched flag per query and doc_id slot, so at most pass_rows rows at once
+    pass_rows = max(1, BATCH_BYTES // (9 * len(accumulator)))
+    results = []
+    for first in range(0, len(tokenized_queries), pass_rows):
+        pass_queries = tokenized_queries[first:first + pass_rows]
+        scores = np.zeros((len(pass_queries), len(accumulator)), dtype=np.float64)
+        touched = np.zeros(scores.shape, dtype=bool)
+        for position in range(max(map(len, pass_queries), default=0)):
+            rows = {}   # term -> queries with the term at this position
+            for row, tokenized_query in enumerate(pass_queries):
+                if position < len(tokenized_query):
+                    rows.setdefault(tokenized_query[position], []).append(row)
+            for term, term_rows in rows.items():
+                doc_ids, weights = arrays[term]
+                term_weights = np.array([query_weights[first + row][term] for row in term_rows])
+                term_rows = np.array(term_rows)[:, None]
+                scores[term_rows, doc_ids] += term_weights[:, None] * weights
+                touched[term_rows, doc_ids] = True
+
+        for row, tokenized_query in enumerate(pass_queries):
+            if not tokenized_query:
+                results.append([])
+                continue
+            doc_ids = np.flatnonzero(touched[row])
+            profiling.count('candidates', len(doc_ids))
+            results.append(get_top_docs_numpy(doc_ids, scores[row, doc_ids], k, with_scores, doc_map))
+    return results
+
+
+def compute_score_impact(tokenized_query, global_dict, impact, accumulator, budget=IMPACT_BUDGET):
+    """
+    Score at a time scoring into the dense accumulator, which is left zeroed again on return.
+    The impact segments of every query term are added in decreasing order of the largest contribution
+    of their postings (query weight x impact level), and scoring stops once budget (a fraction) of the
+    query's postings have been added: the docs and weights left out are those that change the scores
+    the least. With a budget of 1 every posting is added, as in compute_score_numpy.
+
+    Returns (doc_ids, scores) numpy arrays of every doc scored
+    """
+    if not tokenized_query:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    query_ltc_scores = compute_ltc_scores(tokenized_query, global_dict)
+    term_segments = []
+    total = 0
+    with profiling.timer('fetch'):
+        for term, query_score in query_ltc_scores.items():
+            query_score *= tokenized_query.count(term)   # repeated terms are added once per occurrence
+            for level, count, docs, weights in impact.segments(global_dict[term][0]):
+                term_segments.append((level * query_score, query_score, count, docs, weights))
+                total += count
+    term_segments.sort(key=lambda segment: -segment[0])
+
+    touched = []
+    scored = 0
+    for _, query_score, count, docs, weights in term_segments:
+        if scored >= budget * total:
+            break
+        doc_ids = postings_format.decode_doc_ids_array(docs)
+        accumulator[doc_ids] += np.frombuffer(weights, dtype='<f4') * query_score
+        touched.append(doc_ids)
+        scored += count
+    profiling.count('postings_decoded', scored)
+    profiling.count('postings_skipped', total - scored)
+    if not touched:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    doc_ids = np.unique(np.concatenate(touched))
+    profiling.count('candidates', len(doc_ids))
+    scores = accumulator[doc_ids]
+    accumulator[doc_ids] = 0
+    return doc_ids, scores
+
+
+@profiling.timed('fetch')
+def convert_term_to_arrays(term, global_dict, postings, cache=None):
+    """
+    Same as convert_term_to_postings, but returns numpy arrays (doc_ids int64, weights float64)
+    """
+    if cache is not None:
+        arrays = cache.postings.get((term, 'arrays'))
+        if arrays is None:
+            arrays = convert_term_to_arrays(term, global_dict, postings)
+            for a in arrays:
+                a.setflags(write=False)   # shared by later queries
+            cache.postings.put((term, 'arrays'), arrays)
+        else:
+            profiling.count('postings_cache_hits')
+        return arrays
+
+    if not isinstance(postings, segments.SegmentedIndex) and postings.weight_format is not None:
+        count_fetch(global_dict[term])
+        return postings.arrays(global_dict[term][2])
+    posting_list = convert_term_to_postings(term, global_dict, postings)
+    doc_ids = np.array([p[0] for p in posting_list], dtype=np.int64)
+    weights = np.array([p[1] for p in posting_list], dtype=np.float64)
+    return doc_ids, weights
+
+
 def compute_ltc_scores(query_list, global_dict):
     term_ltc_scores = {}
     for query in query_list:
@@ -126,6 +892,8 @@ def compute_ltc_scores(query_list, global_dict):
     for lt in term_ltc_scores.values():
         sum_of_squares += lt * lt
     vector_length = sum_of_squares ** 0.5
+    if vector_length == 0:  # every term is in every doc (idf 0), leave the zero weights as they are
+        return term_ltc_scores
 
     # Normalize vector
     for term, lt in term_ltc_scores.items():
@@ -133,48 +901,567 @@ def compute_ltc_scores(query_list, global_dict):
     return term_ltc_scores
 
 
-def get_top_docs(score):
-    # convert key:value pairs in score to (-value, key) tuples.     Use -value as heapq in python is min heap
-    score_docid_tuples = [(v * -1, k) for k, v in score.items()]
+def phrase_top_docs(tokenized_query, global_dict, postings, positions, term_ids, k=10, with_scores=False,
+                    cache=None, doc_map=None):
+    """
+    Top k docs of a query with phrase or proximity operators, ordered like get_top_docs
+
+    The docs are scored by lnc.ltc with compute_score, and those holding every operator term are
+    checked in decreasing order of score, in batches of PHRASE_CANDIDATES * k docs doubling each
+    time, until k of them match every operator. Only the positions of the operator terms in the
+    docs being checked are read.
+    positions: the PositionsReader of the index, term_ids: the term_id of every operator term
+    doc_map: see get_top_docs
+    """
+    score = compute_score(tokenized_query, global_dict, postings, cache)
+    if not score:
+        return []
+    candidates = None
+    for term in sorted(term_ids, key=lambda term: global_dict[term][4]):   # rarest first
+        term_docs = [posting[0] for posting in convert_term_to_postings(term, global_dict, postings, cache)]
+        candidates = set(term_docs) if candidates is None else candidates.intersection(term_docs)
+    ranked = sorted((-score[doc_id], doc_id if doc_map is None else doc_map[doc_id], doc_id)
+                    for doc_id in candidates)
+    top = []
+    start = 0
+    batch_size = PHRASE_CANDIDATES * k
+    while start < len(ranked):
+        batch = ranked[start:start + batch_size]
+        start += batch_size
+        batch_size *= 2
+        profiling.count('phrase_candidates', len(batch))
+        doc_ids = sorted(doc_id for _, _, doc_id in batch)
+        with profiling.timer('positions'):
+            found = {term: positions.positions(term_id, doc_ids) for term, term_id in term_ids.items()}
+        for neg_score, _, doc_id in batch:
+            if all(match_phrase([found[term][doc_id] for term in terms], slop)
+                   for terms, slop in tokenized_query.phrases):
+                top.append((doc_id, -neg_score) if with_scores else doc_id)
+                if len(top) == k:
+                    return top
+    return top
+
+
+def match_phrase(term_positions, slop=None):
+    """
+    Whether the sorted positions of the terms of an operator, in query order, hold the terms next to
+    each other in this order (slop None), or all within len(term_positions) + slop positions
+    """
+    if slop is None:
+        following = [set(positions) for positions in term_positions[1:]]
+        return any(all(position + i in positions for i, positions in enumerate(following, 1))
+                   for position in term_positions[0])
+    # a term repeated in the operator needs as many distinct positions in the window
+    needed = {}
+    for positions in term_positions:
+        needed[tuple(positions)] = needed.get(tuple(positions), 0) + 1
+    counts = list(needed.values())
+    # slide over the positions of all the terms in increasing order, growing the window up to the
+    # next position and shrinking it from the lowest one while it still holds every term
+    width = len(term_positions) + slop
+    events = sorted((position, group) for group, positions in enumerate(needed) for position in positions)
+    inside = [0] * len(counts)
+    missing = len(counts)
+    start = 0
+    for highest, group in events:
+        inside[group] += 1
+        if inside[group] == counts[group]:
+            missing -= 1
+        while not missing:
+            lowest, first_group = events[start]
+            if highest - lowest < width:
+                return True
+            inside[first_group] -= 1
+            if inside[first_group] < counts[first_group]:
+                missing += 1
+            start += 1
+    return False
+
+
+@profiling.timed('top_k')
+def get_top_docs(score, k=10, with_scores=False, doc_map=None):
+    """
+    Returns the k doc_ids with the highest scores (smaller doc_id first on equal scores),
+    or (doc_id, score) pairs if with_scores
+    doc_map: the external doc_ids of a reordered index, on which equal scores are ordered instead
+    """
+    # (-value, key) tuples as heapq in python is min heap; nsmallest only keeps a heap of k items
+    if doc_map is None:
+        top = heapq.nsmallest(k, ((-v, doc_id) for doc_id, v in score.items()))
+    else:
+        top = [(neg_score, doc_id) for neg_score, _, doc_id
+               in heapq.nsmallest(k, ((-v, doc_map[doc_id], doc_id) for doc_id, v in score.items()))]
+    if with_scores:
+        return [(doc_id, -neg_score) for neg_score, doc_id in top]
+    return [doc_id for _, doc_id in top]
+
+
+@profiling.timed('top_k')
+def get_top_docs_numpy(doc_ids, scores, k=10, with_scores=False, doc_map=None):
+    """
+    Top k doc_ids by decreasing score then increasing doc_id, like get_top_docs
+    """
+    if len(scores) > k:
+        # keep every doc scoring at least the k-th largest score so ties are broken on doc_id below
+        kth_score = np.partition(scores, len(scores) - k)[len(scores) - k]
+        selected = scores >= kth_score
+        doc_ids = doc_ids[selected]
+        scores = scores[selected]
+    tie_ids = doc_ids if doc_map is None else np.frombuffer(doc_map, dtype=doc_map.typecode)[doc_ids]
+    order = np.lexsort((tie_ids, -scores))[:k]
+    if with_scores:
+        return list(zip(doc_ids[order].tolist(), scores[order].tolist()))
+    return doc_ids[order].tolist()
+
+
+class PostingsCursor:
+    """
+    Document at a time iterator over a binary posting list
+
+    The list is split into the blocks delimited by its skip table and decoded one block at a
+    time: next_geq jumps over whole blocks through the skip table, and block_max gives the
+    largest weight of the block holding a doc_id without decoding it.
+    """
+
+    def __init__(self, term, global_dict, postings):
+        entry = global_dict[term]
+        self.max_weight = entry[5] if len(entry) > 5 else 1.0
+        self.weight_format = postings.weight_format
+        self.term_postings = postings.record(entry[2])
+        skips = postings_format.decode_skips(self.term_postings)
+        self.block_size = postings_format.skip_distance(self.term_postings.doc_freq) or self.term_postings.doc_freq
+        first_doc = postings_format.decode_varint(self.term_postings.docs, 0)[0]
+        self.block_starts = [first_doc] + [doc_id for doc_id, _ in skips]
+        self.block_positions = [0] + [pos for _, pos in skips]
+        self.block_maxes = postings_format.decode_weights(self.term_postings.block_max, self.weight_format)
+        self.block = -1
+        self.load_block(0)
+
+    def load_block(self, block):
+        """
+        Decode block and move the cursor to its first posting
+        """
+        self.block = block
+        self.i = 0
+        if block >= len(self.block_starts):
+            self.doc_ids = []
+            self.doc = END_OF_POSTINGS
+            return
+        start = block * self.block_size
+        end = min(start + self.block_size, self.term_postings.doc_freq)
+        docs = self.term_postings.docs
+        doc_id = self.block_starts[block]
+        pos = postings_format.decode_varint(docs, self.block_positions[block])[1]
+        self.doc_ids = [doc_id]
+        for _ in range(end - start - 1):
+            gap, pos = postings_format.decode_varint(docs, pos)
+            doc_id += gap
+            self.doc_ids.append(doc_id)
+        self.weights = postings_format.decode_weights(self.term_postings.weights[start:end], self.weight_format)
+        self.doc = self.doc_ids[0]
 
-    # add all items in dictionary to a heap
-    heap = []
-    for score_docid in score_docid_tuples:
-        heapq.heappush(heap, score_docid)
+    def weight(self):
+        return self.weights[self.i]
 
-    # get top 10 docs
-    result_list = []
-    for i in range(10):
-        if not heap:
+    def next(self):
+        self.i += 1
+        if self.i < len(self.doc_ids):
+            self.doc = self.doc_ids[self.i]
+        else:
+            self.load_block(self.block + 1)
+
+    def next_geq(self, target):
+        """
+        Move to the first posting with doc_id >= target
+        """
+        if self.doc >= target:
+            return
+        block = bisect.bisect_right(self.block_starts, target) - 1
+        if block > self.block:
+            self.load_block(block)
+        self.i = bisect.bisect_left(self.doc_ids, target, self.i)
+        if self.i < len(self.doc_ids):
+            self.doc = self.doc_ids[self.i]
+        else:
+            self.load_block(self.block + 1)
+
+    def block_max(self, target):
+        """
+        Largest weight of the block that would hold target, or 0 if target is past the end of the list
+        """
+        if target == END_OF_POSTINGS:
+            return 0.0
+        block = max(self.block, bisect.bisect_right(self.block_starts, target) - 1)
+        if block >= len(self.block_starts):
+            return 0.0
+        return self.block_maxes[block]
+
+
+class TextPostingsCursor:
+    """
+    Document at a time iterator over a text posting list, parsed in place in the memory map
+
+    Entries are 'doc_id,tf' or 'doc_id,tf,skip'. A skip of s means the entry k positions ahead
+    starts s bytes after the start of the next entry, so next_geq follows skips whose target doc_id
+    is still <= the doc_id sought without parsing the entries in between.
+    """
+
+    def __init__(self, term, global_dict, postings):
+        entry = global_dict[term]
+        # lnc weights are at most 1, which bounds dictionaries written without max_weight
+        self.max_weight = entry[5] if len(entry) > 5 else 1.0
+        self.mmap = postings.mmap
+        self.end = self.mmap.find(b'\n', entry[2])
+        if self.end < 0:
+            self.end = len(self.mmap)
+        self.read_entry(entry[2])
+
+    def read_entry(self, pos):
+        self.pos = pos
+        if pos >= self.end:
+            self.doc = END_OF_POSTINGS
+            return
+        self.entry_end = self.mmap.find(b' ', pos, self.end)
+        if self.entry_end < 0:
+            self.entry_end = self.end
+        components = self.mmap[pos:self.entry_end].split(b',')
+        self.doc = int(components[0])
+        self.tf = components[1]
+        self.skip = int(components[2]) if len(components) > 2 else 0
+
+    def doc_at(self, pos):
+        return int(self.mmap[pos:self.mmap.find(b',', pos, self.end)])
+
+    def weight(self):
+        return float(self.tf)
+
+    def next(self):
+        self.read_entry(self.entry_end + 1)
+
+    def next_geq(self, target):
+        """
+        Move to the first posting with doc_id >= target, following skip pointers where possible
+        """
+        while self.doc < target:
+            if self.skip:
+                skip_pos = self.entry_end + 1 + self.skip
+                if self.doc_at(skip_pos) <= target:
+                    self.read_entry(skip_pos)
+                    continue
+            self.next()
+
+    def block_max(self, target):
+        return 0.0 if self.doc == END_OF_POSTINGS else self.max_weight
+
+
+class SegmentedPostingsCursor:
+    """
+    Document at a time iterator over the live postings of a term in a SegmentedIndex,
+    which are decoded and merged from every segment up front
+    """
+
+    def __init__(self, term, global_dict, postings):
+        self.max_weight = global_dict[term][5]
+        posting_list = postings.term_postings(term)
+        self.doc_ids = [p[0] for p in posting_list]
+        self.weights = [p[1] for p in posting_list]
+        self.i = 0
+        self.doc = self.doc_ids[0] if self.doc_ids else END_OF_POSTINGS
+
+    def weight(self):
+        return self.weights[self.i]
+
+    def next(self):
+        self.i += 1
+        self.doc = self.doc_ids[self.i] if self.i < len(self.doc_ids) else END_OF_POSTINGS
+
+    def next_geq(self, target):
+        if self.doc >= target:
+            return
+        self.i = bisect.bisect_left(self.doc_ids, target, self.i)
+        self.doc = self.doc_ids[self.i] if self.i < len(self.doc_ids) else END_OF_POSTINGS
+
+    def block_max(self, target):
+        return 0.0 if self.doc == END_OF_POSTINGS else self.max_weight
+
+
+@profiling.timed('fetch')
+def open_cursor(term, global_dict, postings):
+    profiling.count('cursors')
+    if isinstance(postings, segments.SegmentedIndex):
+        return SegmentedPostingsCursor(term, global_dict, postings)
+    if postings.weight_format is None:
+        return TextPostingsCursor(term, global_dict, postings)
+    return PostingsCursor(term, global_dict, postings)
+
+
+def maxscore_top_docs(tokenized_query, global_dict, postings, k=10, with_scores=False, doc_map=None):
+    """
+    Document at a time MaxScore evaluation returning the same top k as compute_score + get_top_docs
+
+    Terms are ordered by their score upper bound (max_weight * ltc * occurrences in the query). Once k
+    docs are held, the terms whose bounds add up to at most the k-th score are non-essential: a doc
+    that only contains them cannot enter the top k, so candidates are only taken from the essential
+    terms, and the non-essential terms are probed with next_geq (and their block maxima) only
+    while the candidate can still beat the threshold.
+    Scores are summed in query token order, exactly like compute_score.
+    doc_map: see get_top_docs
+    """
+    if not tokenized_query:
+        return []
+    query_ltc_scores = compute_ltc_scores(tokenized_query, global_dict)
+    occurrences = {}
+    for token in tokenized_query:
+        occurrences[token] = occurrences.get(token, 0) + 1
+
+    terms = list(occurrences)
+    cursors = [open_cursor(term, global_dict, postings) for term in terms]
+    ltc = [query_ltc_scores[t] for t in terms]
+    multiplier = [query_ltc_scores[t] * occurrences[t] for t in terms]
+    order = sorted(range(len(terms)), key=lambda i: cursors[i].max_weight * multiplier[i])
+    terms, cursors, ltc, multiplier = ([x[i] for i in order] for x in (terms, cursors, ltc, multiplier))
+    upper_bounds = [c.max_weight * m for c, m in zip(cursors, multiplier)]
+    # prefix_bounds[i] is the total upper bound of terms[:i + 1]
+    prefix_bounds = []
+    total = 0.0
+    for ub in upper_bounds:
+        total += ub
+        prefix_bounds.append(total)
+    token_positions = [terms.index(token) for token in tokenized_query]
+
+    heap = []   # (score, -doc_id, doc_id) so the worst of the top k is at heap[0], -doc_map[doc_id] if mapped
+    threshold = -1.0
+    first_essential = 0
+    essential = list(range(len(terms)))
+    contributions = [0.0] * len(terms)
+    candidates = 0
+    while True:
+        doc_id = min([cursors[i].doc for i in essential])
+        if doc_id == END_OF_POSTINGS:
             break
-        score_docid = heapq.heappop(heap)
-        result_list.append(score_docid[1])
+        candidates += 1
 
-    return result_list
+        bound = prefix_bounds[first_essential - 1] if first_essential else 0.0
+        for i in essential:
+            cursor = cursors[i]
+            if cursor.doc == doc_id:
+                contributions[i] = cursor.weight() * ltc[i]
+                bound += contributions[i] * occurrences[terms[i]]
+                cursor.next()
+            else:
+                contributions[i] = 0.0
 
+        for i in range(first_essential - 1, -1, -1):
+            contributions[i] = 0.0
+            if bound + PRUNING_EPSILON <= threshold:
+                continue
+            cursor = cursors[i]
+            # replace the term's bound by the bound of the block holding doc_id before decoding it
+            block_bound = cursor.block_max(doc_id) * multiplier[i]
+            bound -= upper_bounds[i] - block_bound
+            if bound + PRUNING_EPSILON <= threshold:
+                continue
+            cursor.next_geq(doc_id)
+            if cursor.doc == doc_id:
+                contributions[i] = cursor.weight() * ltc[i]
+                bound += contributions[i] * occurrences[terms[i]] - block_bound
+            else:
+                bound -= block_bound
+        if bound + PRUNING_EPSILON <= threshold:
+            continue
 
-dictionary_file = postings_file = file_of_queries = output_file_of_results = None
+        score = 0.0
+        for i in token_positions:
+            score += contributions[i]
+        entry = (score, -doc_id if doc_map is None else -doc_map[doc_id], doc_id)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry > heap[0]:
+            heapq.heapreplace(heap, entry)
+        else:
+            continue
 
-try:
-    opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
-except getopt.GetoptError:
-    usage()
-    sys.exit(2)
-
-for o, a in opts:
-    if o == '-d':
-        dictionary_file = a
-    elif o == '-p':
-        postings_file = a
-    elif o == '-q':
-        file_of_queries = a
-    elif o == '-o':
-        file_of_output = a
-    else:
-        assert False, "unhandled option"
+        if len(heap) == k:
+            threshold = heap[0][0]
+            while first_essential < len(terms) and prefix_bounds[first_essential] + PRUNING_EPSILON <= threshold:
+                first_essential += 1
+            if first_essential == len(terms):
+                break
+            essential = list(range(first_essential, len(terms)))
+
+    profiling.count('candidates', candidates)
+    top = sorted(heap, reverse=True)
+    if with_scores:
+        return [(doc_id, score) for score, _, doc_id in top]
+    return [doc_id for _, _, doc_id in top]
+
+
+def conjunctive_top_docs(tokenized_query, global_dict, postings, min_match=ALL_TERMS, k=10, with_scores=False,
+                         doc_map=None):
+    """
+    Top k docs (by lnc.ltc, like compute_score) among the docs containing at least min_match of the
+    distinct query terms, or all of them for ALL_TERMS
+
+    A matching doc must appear in one of the n - min_match + 1 rarest lists, so candidates are only
+    drawn from those; the longer lists are probed with next_geq, which follows the skip pointers
+    instead of decoding every entry. When all terms are required, a miss moves the rarest list
+    straight to the doc_id the probed list landed on.
+    doc_map: see get_top_docs
+    """
+    if not tokenized_query:
+        return []
+    query_ltc_scores = compute_ltc_scores(tokenized_query, global_dict)
+    terms = sorted(set(tokenized_query), key=lambda t: -global_dict[t][1])   # rarest (highest idf) first
+    n = len(terms)
+    required = n if min_match == ALL_TERMS else max(1, min(min_match, n))
+    cursors = [open_cursor(term, global_dict, postings) for term in terms]
+    num_leaders = n - required + 1
+
+    score = {}
+    while True:
+        doc_id = min([cursor.doc for cursor in cursors[:num_leaders]])
+        if doc_id == END_OF_POSTINGS:
+            break
+
+        contributions = {}
+        for i in range(num_leaders):
+            if cursors[i].doc == doc_id:
+                contributions[terms[i]] = cursors[i].weight() * query_ltc_scores[terms[i]]
+                cursors[i].next()
+        for i in range(num_leaders, n):
+            if len(contributions) + n - i < required:
+                break
+            cursor = cursors[i]
+            cursor.next_geq(doc_id)
+            if cursor.doc == doc_id:
+                contributions[terms[i]] = cursor.weight() * query_ltc_scores[terms[i]]
+            elif required == n:
+                cursors[0].next_geq(cursor.doc)
+                break
+
+        if len(contributions) >= required:
+            doc_score = 0.0
+            for token in tokenized_query:
+                if token in contributions:
+                    doc_score += contributions[token]
+            score[doc_id] = doc_score
+
+    profiling.count('candidates', len(score))
+    return get_top_docs(score, k, with_scores, doc_map)
 
-if dictionary_file == None or postings_file == None or file_of_queries == None or file_of_output == None:
-    usage()
-    sys.exit(2)
 
-run_search(dictionary_file, postings_file, file_of_queries, file_of_output)
+if __name__ == '__main__':
+    dictionary_file = postings_file = file_of_queries = file_of_output = None
+    serve_address = serve_socket = None
+    scorer = 'dict'
+    workers = 1
+    start = 0
+    min_match = 0
+    k = 10
+    with_scores = False
+    cache_sizes = [RESULT_CACHE_BYTES, POSTINGS_CACHE_BYTES]
+    trace_file = profile_file = None
+    budget = IMPACT_BUDGET
+    batch = 0
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:k:', ['scorer=', 'conjunctive', 'min-match=',
+                                                                 'with-scores', 'serve=', 'socket=', 'workers=',
+                                                                 'start=', 'result-cache=', 'postings-cache=',
+                                                                 'trace=', 'profile=', 'impact-budget=', 'batch='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            file_of_queries = a
+        elif o == '-o':
+            file_of_output = a
+        elif o == '-k':  # number of results per query
+            k = int(a)
+        elif o == '--with-scores':  # write doc_id,score pairs
+            with_scores = True
+        elif o == '--serve':  # run as a server on host:port
+            host, _, port = a.rpartition(':')
+            serve_address = (host or 'localhost', int(port))
+        elif o == '--socket':  # run as a server on a unix socket
+            serve_socket = a
+        elif o == '--workers':  # number of processes ranking queries
+            workers = int(a)
+        elif o == '--start':  # resume from this query
+            start = int(a)
+        elif o == '--result-cache':  # bytes of cached query results, 0 disables
+            cache_sizes[0] = int(a)
+        elif o == '--postings-cache':  # bytes of cached decoded posting lists, 0 disables
+            cache_sizes[1] = int(a)
+        elif o == '--trace':  # write a JSON line of timings and counters per query
+            trace_file = a
+        elif o == '--profile':  # write the total timings and counters as JSON
+            profile_file = a
+        elif o == '--scorer':
+            scorer = a
+        elif o == '--impact-budget':  # fraction of the postings of a query scored by the impact scorer
+            budget = float(a)
+        elif o == '--batch':  # rank this many queries together, decoding each term once per batch
+            batch = int(a)
+        elif o == '--conjunctive':  # every query term is required
+            min_match = ALL_TERMS
+        elif o == '--min-match':  # at least this many distinct query terms are required
+            min_match = int(a)
+        else:
+            assert False, "unhandled option"
+
+    serving = serve_address != None or serve_socket != None
+    if dictionary_file == None or postings_file == None:
+        usage()
+        sys.exit(2)
+    if not serving and (file_of_queries == None or file_of_output == None):
+        usage()
+        sys.exit(2)
+
+    if scorer not in SCORERS or k < 1 or batch < 0 or start < 0 or not 0 < budget <= 1:
+        usage()
+        sys.exit(2)
+    if start and not serving and not os.path.exists(file_of_output):
+        print(f'--start {start} keeps the results already in {file_of_output}, which does not exist')
+        usage()
+        sys.exit(2)
+    if scorer in ACCUMULATOR_SCORERS and np is None:
+        print(f'the {scorer} scorer requires numpy')
+        sys.exit(2)
+    if batch and np is None:
+        print('--batch requires numpy')
+        sys.exit(2)
+    if batch and min_match:
+        print('--batch ranks every doc containing a query term, without --conjunctive or --min-match')
+        usage()
+        sys.exit(2)
+    if batch and scorer not in ('dict', 'numpy'):
+        print('--batch ranks the queries with the numpy scorer, without --scorer maxscore or impact')
+        usage()
+        sys.exit(2)
+    if batch and workers > 1:
+        print('--batch ranks the queries in this process, ignoring --workers')
+    if scorer == 'impact' and not os.path.exists(postings_file + postings_format.IMPACT_SUFFIX):
+        print('no impact ordered postings (index.py --impact), ranking with the dict scorer')
+
+    if trace_file or profile_file:
+        profiling.enable(trace_file)
+        if workers > 1:
+            print('profiling ranks the queries in this process, ignoring --workers')
+            workers = 1
+
+    if serving:
+        serve(dictionary_file, postings_file, serve_address, serve_socket, scorer, min_match, k,
+              tuple(cache_sizes), budget)
+    else:
+        run_search(dictionary_file, postings_file, file_of_queries, file_of_output, scorer, min_match, k,
+                   with_scores, workers, start, tuple(cache_sizes), budget, batch)
+    if profile_file:
+        profiling.write_summary(profile_file, {'stem_cache': analyzer.stem_cache.stats()})
+    profiling.disable()
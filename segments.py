@@ -0,0 +1,255 @@
+"""
+Segmented index shared by index.py and search.py
+
+index.py --add indexes a batch of new documents into a delta segment, and --delete records the
+deleted doc_ids as tombstones, so the collection changes without a full rebuild. The segments are
+listed in a manifest, written in place of dictionary.txt:
+
+    {"_segments": [{"dict": "dictionary.txt.0", "postings": "postings.txt.0", "deleted": [doc_id, ...]},
+                   ...],
+     "_next_segment": 2}
+
+Every segment is a complete index written by build_index (paths are relative to the manifest).
+index.py --shards writes the same manifest with a "_shards" key: its segments are shards partitioning
+the collection, which search.py ranks in parallel (ShardView) instead of merging their postings.
+Segments are disjoint in live doc_ids: re-adding a doc tombstones its older copy. The idf and doc_freq
+stored in a segment only count its own docs, so SegmentedIndex recomputes them over the live docs of
+every segment at search time. index.py --compact folds the segments back into one.
+
+index.py --prune-weight and --tier-df move the postings that matter least out of a plain index into a
+secondary tier, dictionary.txt.tier and postings.txt.tier. TieredIndex views both tiers as one index.
+"""
+import fcntl
+import json
+import math
+import os
+import postings_format
+import lexicon
+from cache import LRUCache
+
+UNIVERSAL = '_universal'  # dummy term written by index.py whose posting list holds every doc_id
+MANIFEST_PREFIX = b'{"_segments"'
+STATS_CACHE_SIZE = 100000  # number of terms whose corrected (idf, doc_freq, max_weight) are kept
+MAX_SEGMENTS = 8  # index.py --add starts a background compaction above this many segments
+TIER_SUFFIX = '.tier'  # appended to the dictionary and postings file names of the secondary tier
+
+
+def is_manifest(dict_file):
+    with open(dict_file, 'rb') as f:
+        return f.read(len(MANIFEST_PREFIX)) == MANIFEST_PREFIX
+
+
+def read_manifest(manifest_file):
+    with open(manifest_file, 'r') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest_file, manifest):
+    """
+    Replace the manifest atomically, so searchers always read a complete one
+    """
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f)  # '_segments' is always the first key, see MANIFEST_PREFIX
+    os.replace(tmp_file, manifest_file)
+
+
+class ManifestLock:
+    """
+    Exclusive lock held while reading and rewriting the manifest, so an --add or --delete running
+    next to a background compaction does not lose its update
+    """
+
+    def __init__(self, manifest_file):
+        self.lock_file = manifest_file + '.lock'
+
+    def __enter__(self):
+        self.f = open(self.lock_file, 'w')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+
+def is_sharded(dict_file):
+    return is_manifest(dict_file) and '_shards' in read_manifest(dict_file)
+
+
+def segment_path(manifest_file, name):
+    return os.path.join(os.path.dirname(manifest_file), name)
+
+
+def open_segment(manifest_file, segment):
+    """
+    Returns (global_dict, postings) of a segment of the manifest
+    """
+    global_dict = lexicon.load_dictionary(segment_path(manifest_file, segment['dict']))
+    postings = postings_format.PostingsReader(segment_path(manifest_file, segment['postings']))
+    return global_dict, postings
+
+
+def universal_doc_ids(global_dict, postings):
+    """
+    Returns the list of all doc_ids of an index, read from its universal posting list
+    """
+    offset = global_dict[UNIVERSAL][2]
+    if postings.weight_format is not None:
+        return [posting[0] for posting in postings.postings(offset)]
+    # text entries are 'doc_id' or 'doc_id,skip_ptr'
+    return [int(posting.split(b',')[0]) for posting in bytes(postings.line(offset)).split()]
+
+
+def decode_posting_list(entry, postings):
+    """
+    Returns the posting list of a dictionary entry as [[doc_id, weight], ...]
+    """
+    if postings.weight_format is not None:
+        return postings.postings(entry[2])
+    posting_list = []
+    for posting in bytes(postings.line(entry[2])).split():
+        components = posting.split(b',')
+        posting_list.append([int(components[0]), float(components[1])])
+    return posting_list
+
+
+class SegmentedIndex:
+    """
+    Read only view of every segment of a manifest, usable in place of a single dictionary:
+    'term in index' and index[term] -> (None, idf, None, None, doc_freq, max_weight), with idf and
+    doc_freq counted over the live docs of all segments
+
+    term_postings returns the live postings of a term merged from every segment in doc_id order.
+    """
+
+    def __init__(self, manifest_file, manifest_segments=None):
+        """
+        manifest_segments: the segments to open, all the segments of the manifest by default
+        """
+        if manifest_segments is None:
+            manifest_segments = read_manifest(manifest_file)['_segments']
+        self.segments = []  # (global_dict, postings, deleted doc_ids)
+        self.doc_ids = []
+        for segment in manifest_segments:
+            global_dict, postings = open_segment(manifest_file, segment)
+            deleted = set(segment['deleted'])
+            self.segments.append((global_dict, postings, deleted))
+            self.doc_ids.extend(d for d in universal_doc_ids(global_dict, postings) if d not in deleted)
+        self.doc_ids.sort()
+        self.stats = LRUCache(STATS_CACHE_SIZE)
+
+    def terms(self):
+        """
+        Returns the sorted terms of every segment, some may have no live posting
+        """
+        terms = set()
+        for global_dict, _, _ in self.segments:
+            terms.update(global_dict)
+        terms.discard(UNIVERSAL)
+        return sorted(terms)
+
+    def term_stats(self, term):
+        """
+        Returns (idf, doc_freq, max_weight) of term over the live docs, doc_freq is 0 for unknown terms
+        """
+        stats = self.stats.get(term)
+        if stats is not None:
+            return stats
+        doc_freq = 0
+        max_weight = 0.0
+        for global_dict, postings, deleted in self.segments:
+            entry = global_dict.get(term)
+            if entry is None:
+                continue
+            if deleted:
+                doc_freq += sum(1 for doc_id, _ in decode_posting_list(entry, postings) if doc_id not in deleted)
+            else:
+                doc_freq += entry[4]
+            max_weight = max(max_weight, entry[5] if len(entry) > 5 else 1.0)
+        idf = math.log(len(self.doc_ids) / doc_freq) if doc_freq else 0.0
+        stats = (idf, doc_freq, max_weight)
+        self.stats.put(term, stats)
+        return stats
+
+    def __contains__(self, term):
+        return self.term_stats(term)[1] > 0
+
+    def __getitem__(self, term):
+        idf, doc_freq, max_weight = self.term_stats(term)
+        if not doc_freq:
+            raise KeyError(term)
+        return None, idf, None, None, doc_freq, max_weight
+
+    def get(self, term, default=None):
+        return self[term] if term in self else default
+
+    def term_postings(self, term):
+        """
+        Returns the live postings of term as [[doc_id, weight], ...] sorted by doc_id
+        """
+        posting_lists = []
+        for global_dict, postings, deleted in self.segments:
+            entry = global_dict.get(term)
+            if entry is None:
+                continue
+            posting_list = decode_posting_list(entry, postings)
+            if deleted:
+                posting_list = [p for p in posting_list if p[0] not in deleted]
+            posting_lists.append(posting_list)
+        if len(posting_lists) == 1:
+            return posting_lists[0]
+        return sorted((p for posting_list in posting_lists for p in posting_list), key=lambda p: p[0])
+
+    def close(self):
+        for _, postings, _ in self.segments:
+            postings.close()
+
+
+class ShardView(SegmentedIndex):
+    """
+    SegmentedIndex of the segments of one shard that scores with the statistics of the whole index:
+    term_stats returns the (idf, doc_freq, max_weight) last given to use_global_stats, so scores are
+    comparable across shards
+    """
+
+    def __init__(self, manifest_file, manifest_segments):
+        super().__init__(manifest_file, manifest_segments)
+        self.global_stats = {}
+
+    def use_global_stats(self, global_stats):
+        """
+        global_stats: mapping of term to (idf, doc_freq, max_weight) over every shard
+        """
+        self.global_stats = global_stats
+
+    def term_stats(self, term):
+        return self.global_stats.get(term, (0.0, 0, 0.0))
+
+
+class TieredIndex(SegmentedIndex):
+    """
+    Primary index together with its secondary tier: term_postings merges the postings of a term from
+    both, so a query ranked on this view scores like the unpruned index
+
+    The dictionary entries of the primary hold the idf and max_weight of the whole posting list and the
+    number of postings kept, those of the tier the number of postings moved (its idf is not used).
+    Only the tier is owned, close leaves the primary open.
+    """
+
+    def __init__(self, global_dict, postings, tier_dict, tier_postings):
+        self.segments = [(global_dict, postings, set()), (tier_dict, tier_postings, set())]
+        self.doc_ids = universal_doc_ids(global_dict, postings)
+
+    def term_stats(self, term):
+        entry = self.segments[0][0].get(term)
+        if entry is None:
+            return 0.0, 0, 0.0
+        tier_entry = self.segments[1][0].get(term)
+        return entry[1], entry[4] + (tier_entry[4] if tier_entry else 0), entry[5]
+
+    def close(self):
+        tier_dict, tier_postings, _ = self.segments[1]
+        tier_postings.close()
+        if isinstance(tier_dict, lexicon.Lexicon):
+            tier_dict.close()
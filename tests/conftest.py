@@ -0,0 +1,51 @@
+"""
+Shared helpers of the regression tests, which build small synthetic indexes in a temporary directory
+
+    python3 -m pytest tests
+"""
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench import corpus  # noqa: E402
+
+
+def write_corpus(out_dir, num_docs, doc_length=40, vocab_size=500, seed=0):
+    """
+    Write num_docs documents of Zipf distributed words as files 1..num_docs of out_dir, and return
+    the vocabulary, most frequent word first
+    Documents are plain words without punctuation, so they are tokenized without the punkt model.
+    """
+    rng = random.Random(seed)
+    vocabulary = corpus.make_vocabulary(vocab_size, seed)
+    cum_weights = corpus.zipf_weights(vocab_size)
+    os.makedirs(out_dir, exist_ok=True)
+    for doc_id in range(1, num_docs + 1):
+        length = rng.randint(doc_length // 2, doc_length * 3 // 2)
+        with open(os.path.join(out_dir, str(doc_id)), 'w') as f:
+            f.write(' '.join(rng.choices(vocabulary, cum_weights=cum_weights, k=length)))
+    return vocabulary
+
+
+def read_files(*paths):
+    """
+    Contents of the files, in bytes
+    """
+    contents = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            contents.append(f.read())
+    return contents
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """
+    Temporary working directory of a test, where index.py writes its blocks
+    """
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,79 @@
+"""
+Regression tests of index.py
+"""
+import contextlib
+import os
+
+import pytest
+
+import index
+import search
+from conftest import read_files, write_corpus
+
+resource = pytest.importorskip('resource')
+
+
+@contextlib.contextmanager
+def open_files_limit(limit):
+    """
+    Lower the soft limit of open files of this process to limit within the block
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+    try:
+        yield
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+
+def test_merge_fan_in_under_open_files_limit(workdir, monkeypatch):
+    write_corpus('docs', 200)
+    index.build_index('docs', 'dictionary.txt', 'postings.txt')
+
+    # one block per doc, merged 8 at a time under a limit far below the number of blocks
+    monkeypatch.setattr(index, 'MERGE_FAN_IN', 8)
+    with open_files_limit(64):
+        index.build_index('docs', 'budget.txt', 'budget_postings.txt', memory_budget=1)
+    assert read_files('budget.txt', 'budget_postings.txt') == read_files('dictionary.txt', 'postings.txt')
+    assert sorted(os.listdir('.')) == ['budget.txt', 'budget_postings.txt', 'dictionary.txt', 'docs',
+                                       'postings.txt']
+
+
+def test_failed_build_leaves_no_blocks(workdir, monkeypatch):
+    write_corpus('docs', 100)
+    monkeypatch.setattr(index, 'MERGE_FAN_IN', 1000)
+    with open_files_limit(64), pytest.raises(OSError):
+        index.build_index('docs', 'dictionary.txt', 'postings.txt', memory_budget=1)
+    assert os.listdir('.') == ['docs']
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_tiny_memory_budget_under_open_files_limit(workdir, workers):
+    write_corpus('docs', 600)
+    index.build_index('docs', 'dictionary.txt', 'postings.txt')
+
+    # a block per doc, more blocks than files may be open, merged MERGE_FAN_IN at a time
+    with open_files_limit(index.MERGE_FAN_IN + 64):
+        index.build_index('docs', 'budget.txt', 'budget_postings.txt', workers=workers, memory_budget=1)
+    assert read_files('budget.txt', 'budget_postings.txt') == read_files('dictionary.txt', 'postings.txt')
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_max_weight_bounds_the_stored_weights(workdir, quantize):
+    write_corpus('docs', 300)
+    index.build_index('docs', 'dictionary.txt', 'postings.txt', binary=True, quantize=quantize)
+    global_dict, postings = search.load_index('dictionary.txt', 'postings.txt')
+    for term in global_dict:
+        weights = [weight for _, weight in search.convert_term_to_postings(term, global_dict, postings)]
+        assert max(weights) <= global_dict[term][5]
+    postings.close()
+
+
+def test_tier_df_below_one_posting_keeps_one(workdir):
+    write_corpus('docs', 300)
+    # 0.001 of 300 docs floors to no posting, which keeps the heaviest one rather than disabling the cut
+    index.build_index('docs', 'dictionary.txt', 'postings.txt', tier_df=0.001)
+    global_dict, postings = search.load_index('dictionary.txt', 'postings.txt')
+    for term in global_dict.keys() - {index.UNIVERSAL}:
+        assert len(search.convert_term_to_postings(term, global_dict, postings)) == 1
+    postings.close()
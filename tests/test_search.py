@@ -0,0 +1,168 @@
+"""
+Regression tests of search.py: the scorers must agree on the same index
+"""
+import itertools
+import os
+import random
+
+import pytest
+
+import index
+import search
+import segments
+from conftest import write_corpus
+
+
+def rank_all(queries, scorer, k, dict_file='dictionary.txt', postings_file='postings.txt', min_match=0):
+    """
+    The (doc_id, score) top k of every query
+    """
+    global_dict, postings = search.load_index(dict_file, postings_file)
+    accumulator = search.new_accumulator(global_dict, postings) if scorer in search.ACCUMULATOR_SCORERS else None
+    results = [search.rank_query(search.parse_query(query, global_dict), global_dict, postings, scorer, min_match,
+                                 k, True, accumulator)
+               for query in queries]
+    postings.close()
+    return results
+
+
+def tie_queries(vocabulary):
+    """
+    Every query of one or two of the words of a small vocabulary, whose docs often tie
+    """
+    return [' '.join(words) for n in (1, 2) for words in itertools.combinations(vocabulary, n)]
+
+
+@pytest.mark.parametrize('quantize', [False, True])
+def test_maxscore_matches_dict_on_reordered_index(workdir, quantize):
+    vocabulary = write_corpus('docs', 500, doc_length=8, vocab_size=20)
+    index.build_index('docs', 'dictionary.txt', 'postings.txt', binary=True, quantize=quantize, reorder_docs=True)
+    queries = tie_queries(vocabulary)
+    for k in (1, 3, 10):
+        assert rank_all(queries, 'maxscore', k) == rank_all(queries, 'dict', k)
+
+
+def test_batch_passes_match_numpy(workdir, monkeypatch):
+    pytest.importorskip('numpy')
+    vocabulary = write_corpus('docs', 300)
+    index.build_index('docs', 'dictionary.txt', 'postings.txt')
+    queries = tie_queries(vocabulary[:12])
+    # room for a handful of rows per pass, so the batch is ranked in many passes
+    monkeypatch.setattr(search, 'BATCH_BYTES', 9 * 301 * 5)
+    global_dict, postings = search.load_index('dictionary.txt', 'postings.txt')
+    accumulator = search.new_accumulator(global_dict, postings)
+    batch = search.rank_batch([search.parse_query(query, global_dict) for query in queries], global_dict, postings,
+                              10, True, accumulator)
+    postings.close()
+    assert batch == rank_all(queries, 'numpy', 10)
+
+
+def random_queries(vocabulary, num_queries=60, seed=0):
+    """
+    Queries of one to four of the more frequent words of the vocabulary
+    """
+    rng = random.Random(seed)
+    return [' '.join(rng.sample(vocabulary[:60], rng.randint(1, 4))) for _ in range(num_queries)]
+
+
+def assert_same_results(results, expected):
+    """
+    Same doc_ids in the same order, with scores equal up to the float32 rounding of binary weights
+    """
+    assert [[doc_id for doc_id, _ in result] for result in results] == \
+        [[doc_id for doc_id, _ in result] for result in expected]
+    for result, expected_result in zip(results, expected):
+        assert [score for _, score in result] == pytest.approx([score for _, score in expected_result], abs=1e-6)
+
+
+def build_text_index(num_docs=300):
+    """
+    The documents of a synthetic corpus in docs/ and their text index in text/, returns the vocabulary
+    """
+    vocabulary = write_corpus('docs', num_docs)
+    os.mkdir('text')
+    index.build_index('docs', 'text/dictionary.txt', 'text/postings.txt')
+    return vocabulary
+
+
+@pytest.mark.parametrize('options', [dict(binary=True), dict(binary_dict=True), dict(binary=True, binary_dict=True),
+                                     dict(reorder_docs=True), dict(binary=True, reorder_docs=True),
+                                     dict(binary=True, impact=True), dict(positions=True),
+                                     dict(binary=True, positions=True)], ids=str)
+def test_scorers_match_dict_on_text_index(workdir, options):
+    pytest.importorskip('numpy')
+    queries = random_queries(build_text_index())
+    os.mkdir('variant')
+    index.build_index('docs', 'variant/dictionary.txt', 'variant/postings.txt', **options)
+    for min_match in (0, 2, search.ALL_TERMS):
+        expected = rank_all(queries, 'dict', 10, 'text/dictionary.txt', 'text/postings.txt', min_match)
+        for scorer in search.SCORERS:
+            assert_same_results(rank_all(queries, scorer, 10, 'variant/dictionary.txt', 'variant/postings.txt',
+                                         min_match), expected)
+
+
+@pytest.mark.parametrize('options', [dict(binary=True, quantize=True), dict(binary=True, quantize=True, impact=True),
+                                     dict(prune_weight=0.3, tier_df=0.05),
+                                     dict(binary=True, prune_weight=0.3, tier_df=0.05)], ids=str)
+def test_scorers_agree_on_lossy_index(workdir, options):
+    pytest.importorskip('numpy')
+    queries = random_queries(build_text_index())
+    index.build_index('docs', 'dictionary.txt', 'postings.txt', **options)
+    for min_match in (0, 2, search.ALL_TERMS):
+        expected = rank_all(queries, 'dict', 10, min_match=min_match)
+        for scorer in search.SCORERS:
+            if scorer == 'impact' and not min_match and options.get('impact') and options.get('quantize'):
+                # the impact file keeps the float32 weights, so it ranks as the text index
+                assert_same_results(rank_all(queries, scorer, 10),
+                                    rank_all(queries, 'dict', 10, 'text/dictionary.txt', 'text/postings.txt'))
+            else:
+                assert_same_results(rank_all(queries, scorer, 10, min_match=min_match), expected)
+
+
+def read_results(results_file):
+    """
+    The (doc_id, score) results of every query of a file written by run_search with with_scores
+    """
+    with open(results_file) as f:
+        return [[(int(doc_id), float(score)) for doc_id, score in (r.split(',') for r in line.split())]
+                for line in f.read().split('\n')]
+
+
+@pytest.mark.parametrize('shard_by', ['range', 'hash'])
+def test_sharded_search_matches_text_index(workdir, shard_by):
+    queries = random_queries(build_text_index())
+    with open('queries.txt', 'w') as f:
+        f.write('\n'.join(queries))
+    index.build_shards('docs', 'dictionary.txt', 'postings.txt', 3, shard_by, binary=True)
+    search.run_search('text/dictionary.txt', 'text/postings.txt', 'queries.txt', 'expected.txt', with_scores=True)
+    for scorer in search.SCORERS:
+        search.run_search('dictionary.txt', 'postings.txt', 'queries.txt', 'results.txt', scorer, with_scores=True)
+        assert_same_results(read_results('results.txt'), read_results('expected.txt'))
+
+
+@pytest.mark.parametrize('binary', [False, True])
+def test_add_and_compact_match_a_rebuild(workdir, binary):
+    vocabulary = write_corpus('docs', 300)
+    # the first 200 docs are indexed, then the last 100 are added with a new version of doc 1
+    os.mkdir('first')
+    os.mkdir('second')
+    for doc_id in range(1, 301):
+        os.link(os.path.join('docs', str(doc_id)), os.path.join('first' if doc_id <= 200 else 'second', str(doc_id)))
+    os.remove(os.path.join('docs', '1'))
+    with open(os.path.join('docs', '1'), 'w') as f:
+        f.write(' '.join(vocabulary[:30]))
+    os.link(os.path.join('docs', '1'), os.path.join('second', '1'))
+    queries = random_queries(vocabulary)
+
+    os.mkdir('full')
+    index.build_index('docs', 'full/dictionary.txt', 'full/postings.txt', binary=binary)
+    index.build_index('first', 'dictionary.txt', 'postings.txt', binary=binary)
+    index.add_documents('second', 'dictionary.txt', 'postings.txt', binary=binary)
+    for compacted in (False, True):
+        if compacted:
+            index.compact_segments('dictionary.txt', 'postings.txt')
+        assert len(segments.read_manifest('dictionary.txt')['_segments']) == (1 if compacted else 2)
+        for min_match in (0, search.ALL_TERMS):
+            expected = rank_all(queries, 'dict', 10, 'full/dictionary.txt', 'full/postings.txt', min_match)
+            for scorer in search.SCORERS:
+                assert_same_results(rank_all(queries, scorer, 10, min_match=min_match), expected)